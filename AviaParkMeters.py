@@ -10,24 +10,32 @@ values of each of them continiously
 class mem: pass
 
 from collections import deque
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import threading
 
-from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+from time import time as _time
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger, DebugContents
 from bacpypes.consolelogging import ConfigArgumentParser
 
 from bacpypes.core import run, deferred
-from bacpypes.task import RecurringTask
+from bacpypes.task import RecurringTask, ClockAlignedTask, FunctionTask, enable_timer_wheel
 
 from bacpypes.pdu import Address
 from bacpypes.app import LocalDeviceObject, BIPSimpleApplication
 from bacpypes.object import get_datatype
 
-from bacpypes.apdu import ReadPropertyRequest, Error, AbortPDU, ReadPropertyACK
+from bacpypes.appservice import DeviceInfo
+from bacpypes.apdu import ReadPropertyRequest, Error, AbortPDU, AbortReason, RejectPDU, ReadPropertyACK, \
+    ReadPropertyMultipleRequest, ReadAccessSpecification, ReadPropertyMultipleACK, \
+    SubscribeCOVRequest, SimpleAckPDU, WhoIsRequest
 from bacpypes.primitivedata import Unsigned
 from bacpypes.constructeddata import Array
-from bacpypes.basetypes import ServicesSupported
+from bacpypes.basetypes import ServicesSupported, PropertyReference
+
+import meterreadings
+from meterreadings import ReadingStore
 
 
 # some debugging
@@ -39,44 +47,172 @@ this_device = None
 this_application = None
 this_console = None
 
-mem.readings_from_counters = {}
-mem.dict_counter_readings = {}
-save_dict={}
+mem.readings = ReadingStore()
 
-mem.skip_first_save=1
-mem.sayac_okuma_flag=1
 
 # Create point list ###########################################################
-from xlrd import open_workbook
-
-book = open_workbook('C:/MeterDefinitions.xls')
-sheet = book.sheet_by_index(0)
-
-number_of_rows = sheet.nrows
-
-point_list = []
-dict_mako = {}
-for row_index in xrange(1, number_of_rows):
-    address=str(sheet.cell(row_index, 6).value)
-    programid=str(int(sheet.cell(row_index, 0).value))
-    object_instance = int(sheet.cell(row_index, 3).value)
-    temp_list = []
-    temp_list.append(address)
-    temp_list.append('analogInput')
-    temp_list.append(object_instance)
-    temp_list.append("presentValue")
-    temp_list.append(programid)
-    point_list.append(temp_list)
-
-    #create dict of dict of list to send to mako
-    grs_key=sheet.cell(row_index, 5).value
-    busbar_key=sheet.cell(row_index, 4).value
-
-    if not grs_key in dict_mako:
-        dict_mako[grs_key] = {}
-    if not busbar_key in dict_mako[grs_key]:
-        dict_mako[grs_key][busbar_key] = []
-    dict_mako[grs_key][busbar_key].append(programid)
+import meterdefs
+
+METER_DEFINITIONS = 'C:/MeterDefinitions.xls'
+
+point_list, dict_mako = meterdefs.load_definitions(METER_DEFINITIONS)
+
+# the points in the current list, a response or notification for a point
+# that has been removed since it was asked for is dropped
+point_set = set(tuple(point) for point in point_list)
+
+#
+#   cast_value
+#
+
+def cast_value(objectIdentifier, propertyIdentifier, propertyArrayIndex, propertyValue):
+    """Turn the Any of a read result into a value of the right datatype."""
+    # find the datatype
+    datatype = get_datatype(objectIdentifier[0], propertyIdentifier)
+    if not datatype:
+        raise TypeError, "unknown datatype"
+
+    # special case for array parts, others are managed by cast_out
+    if issubclass(datatype, Array) and (propertyArrayIndex is not None):
+        if propertyArrayIndex == 0:
+            return propertyValue.cast_out(Unsigned)
+        else:
+            return propertyValue.cast_out(datatype.subtype)
+    else:
+        return propertyValue.cast_out(datatype)
+
+#
+#   reading_quality
+#
+
+def reading_quality(value):
+    """Return the quality of a value from a read or a notification."""
+    if isinstance(value, (int, long, float)):
+        return meterreadings.GOOD
+    elif value is None:
+        return meterreadings.OFFLINE
+    elif isinstance(value, AbortPDU) and (value.apduAbortRejectReason == AbortReason.NORESPONSE):
+        return meterreadings.TIMEOUT
+    else:
+        return meterreadings.ERROR
+
+#
+#   publish_reading
+#
+
+def publish_reading(point, value):
+    """Publish the value for a point as soon as it arrives."""
+    if tuple(point) not in point_set:
+        return
+
+    quality = reading_quality(value)
+    if quality == meterreadings.GOOD:
+        value = float(value)
+    mem.readings.publish(point[4], value, quality)
+
+# encoded sizes used to guess how many points fit in a ReadPropertyMultiple,
+# a result for an analog value or an access error is about 16 octets
+RPM_ACK_HEADER_SIZE = 3
+RPM_RESULT_SIZE = 16
+
+# seconds to hold off reading a device after asking it who it is, so the
+# first requests are sized by what it says it can take
+IAM_WAIT = 3.0
+
+# a device that fails this many requests in a row is skipped for a back-off
+# period (seconds) that doubles each time the probe read fails
+FAILURE_THRESHOLD = 3
+BACKOFF_MIN = 240.0
+BACKOFF_MAX = 3840.0
+
+# bounds for the adaptive response timeout (milliseconds)
+TIMEOUT_MIN = 250
+
+#
+#   DeviceHealth
+#
+
+@bacpypes_debugging
+class DeviceHealth(DebugContents):
+
+    _debug_contents = ('srtt', 'rttvar', 'failures', 'backoff', 'open_until', 'probing')
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self):
+        if _debug: DeviceHealth._debug("__init__")
+
+        # smoothed round trip time and its variation (milliseconds)
+        self.srtt = None
+        self.rttvar = None
+
+        # consecutive failures and the circuit breaker
+        self.failures = 0
+        self.backoff = BACKOFF_MIN
+        self.open_until = 0.0
+        self.probing = False
+
+    def state(self, now):
+        """Return the circuit breaker state."""
+        if self.failures < FAILURE_THRESHOLD:
+            return DeviceHealth.CLOSED
+        elif now < self.open_until:
+            return DeviceHealth.OPEN
+        else:
+            return DeviceHealth.HALF_OPEN
+
+    def retry_timeout(self, default):
+        """Return how long to wait for a response, a smoothed round trip
+        time plus four times its variation like TCP, limited to the default."""
+        if self.srtt is None:
+            return default
+        rto = int(self.srtt + 4 * self.rttvar)
+        return max(TIMEOUT_MIN, min(rto, default))
+
+    def retry_count(self, default):
+        """Return how many times to send a request, a device that has been
+        failing only gets one try."""
+        if self.failures:
+            return 1
+        return default
+
+    def success(self, rtt):
+        if _debug: DeviceHealth._debug("success %r", rtt)
+
+        # update the round trip estimates
+        if rtt is not None:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2.0
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        # close the circuit
+        self.failures = 0
+        self.backoff = BACKOFF_MIN
+        self.open_until = 0.0
+        self.probing = False
+
+    def failure(self, now):
+        if _debug: DeviceHealth._debug("failure %r", now)
+
+        self.failures += 1
+        if self.failures < FAILURE_THRESHOLD:
+            return False
+
+        # open the circuit, back off longer if the probe failed
+        opened = (self.failures == FAILURE_THRESHOLD) or self.probing
+        if self.probing:
+            self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+        self.open_until = now + self.backoff
+        self.probing = False
+
+        # return true if the circuit was just opened
+        return opened
+
 #
 #   PrairieDog
 #
@@ -84,22 +220,107 @@ for row_index in xrange(1, number_of_rows):
 @bacpypes_debugging
 class PrairieDog(BIPSimpleApplication, RecurringTask):
 
-    def __init__(self, interval, *args):
-        if _debug: PrairieDog._debug("__init__ %r, %r", interval, args)
+    def __init__(self, interval, window, device_window, *args):
+        if _debug: PrairieDog._debug("__init__ %r, %r, %r, %r", interval, window, device_window, args)
         BIPSimpleApplication.__init__(self, *args)
         RecurringTask.__init__(self, interval * 1000)
 
-        # keep track of requests to line up responses
-        self._request = None
+        # how many requests can be outstanding, overall and for one device
+        self.window = window
+        self.device_window = device_window
+
+        # keep track of requests to line up responses, the key is the
+        # destination address and the invoke ID, the value is the list
+        # of points in the request
+        self.in_flight = {}
+        self.device_in_flight = {}
+
+        # devices that can only do ReadProperty
+        self.rpm_unsupported = set()
+
+        # devices asked who they are, the address and when to stop waiting
+        self.who_is_pending = {}
+
+        # response times and circuit breakers
+        self.device_health = {}
+
+        # points can be kept up to date by COV notifications
+        self.cov_manager = None
 
         # start out idle
         self.is_busy = False
-        self.point_queue = deque()
-        self.response_values = []
+        self.device_address = {}
+        self.device_queues = {}
+        self.device_ring = deque()
 
         # install it
         self.install_task()
 
+    def get_address(self, addr):
+        """Return the address object for a device in the point list."""
+        address = self.device_address.get(addr)
+        if not address:
+            address = self.device_address[addr] = Address(addr)
+            self.device_health[addr] = DeviceHealth()
+            self.who_is(address)
+        return address
+
+    def discover(self, points):
+        """Ask each device in the point list who it is."""
+        if _debug: PrairieDog._debug("discover")
+
+        for point in points:
+            self.get_address(point[0])
+
+    def who_is(self, address):
+        """Ask a device who it is, the I-Am says how big a request it takes."""
+        if _debug: PrairieDog._debug("who_is %r", address)
+
+        request = WhoIsRequest()
+        request.pduDestination = address
+        self.request(request)
+
+        # come back to the device when the wait is over if it says nothing
+        when = _time() + IAM_WAIT
+        self.who_is_pending[address] = when
+        FunctionTask(self.fill_window).install_task(when)
+
+    def get_device_info(self, address):
+        """Return the device info the state machine access point will use
+        for the address, adding one if it isn't there yet."""
+        info = self.smap.deviceInfo.get(address)
+        if not info:
+            info = DeviceInfo(address)
+            self.smap.set_device_info(info)
+        return info
+
+    def do_IAmRequest(self, apdu):
+        """Remember how big a request the device can take."""
+        if _debug: PrairieDog._debug("do_IAmRequest %r", apdu)
+
+        info = self.get_device_info(apdu.pduSource)
+        info.segmentationSupported = apdu.segmentationSupported
+        info.maxApduLengthAccepted = apdu.maxAPDULengthAccepted
+
+        # the device was waiting for this
+        if self.who_is_pending.pop(apdu.pduSource, None) and self.is_busy:
+            deferred(self.fill_window)
+
+    def do_UnconfirmedCOVNotificationRequest(self, apdu):
+        if _debug: PrairieDog._debug("do_UnconfirmedCOVNotificationRequest %r", apdu)
+
+        if self.cov_manager:
+            self.cov_manager.notification(apdu)
+
+    def do_ConfirmedCOVNotificationRequest(self, apdu):
+        if _debug: PrairieDog._debug("do_ConfirmedCOVNotificationRequest %r", apdu)
+
+        if self.cov_manager:
+            self.cov_manager.notification(apdu)
+
+        # success
+        self.response(SimpleAckPDU(context=apdu))
+
     def process_task(self):
         if _debug: PrairieDog._debug("process_task")
         global point_list
@@ -111,130 +332,566 @@ class PrairieDog(BIPSimpleApplication, RecurringTask):
 
         # now we are busy
         self.is_busy = True
-        mem.sayac_okuma_flag=1
 
-        # turn the point list into a queue
-        self.point_queue = deque(point_list)
-
-        # clean out the list of the response values
-        self.response_values = []
-
-        # fire off the next request
-        self.next_request()
-
-    def next_request(self):
-        if _debug: PrairieDog._debug("next_request")
+        # turn the point list into a queue per device, the devices take
+        # turns in the ring so one slow device doesn't hold up the rest,
+        # points with a COV subscription don't need to be read
+        now = _time()
+        self.device_queues = {}
+        self.device_ring = deque()
+        for point in point_list:
+            if self.cov_manager and self.cov_manager.is_subscribed(point, now):
+                continue
+
+            addr = point[0]
+            if addr not in self.device_queues:
+                self.device_queues[addr] = deque()
+                self.device_ring.append(addr)
+                self.get_address(addr)
+            self.device_queues[addr].append(point)
+
+        # fire off the first batch of requests
+        self.fill_window()
+
+    def batch_size(self, addr):
+        """Return how many points can be read from the device in one request."""
+        if addr in self.rpm_unsupported:
+            return 1
+
+        # the response has to fit in what both sides can handle
+        info = self.get_device_info(self.device_address[addr])
+        max_apdu = min(self.smap.maxApduLengthAccepted, info.maxApduLengthAccepted)
+
+        return max(1, (max_apdu - RPM_ACK_HEADER_SIZE) // RPM_RESULT_SIZE)
+
+    def requeue(self, addr, points):
+        """Put points back at the front of the device queue."""
+        if _debug: PrairieDog._debug("requeue %r %r", addr, points)
+
+        if addr not in self.device_queues:
+            self.device_queues[addr] = deque()
+            self.device_ring.append(addr)
+        self.device_queues[addr].extendleft(reversed(points))
+
+    def update_points(self, added, removed):
+        """The point list changed, drop the removed points from the sweep and
+        read the new ones."""
+        if _debug: PrairieDog._debug("update_points %r %r", added, removed)
+
+        # take the removed points out of the sweep in progress
+        removed_set = set(tuple(point) for point in removed)
+        for addr, queue in self.device_queues.items():
+            points = [point for point in queue if tuple(point) not in removed_set]
+            if len(points) != len(queue):
+                self.device_queues[addr] = deque(points)
+
+        # stop routing notifications to them
+        if self.cov_manager:
+            for key, points in self.cov_manager.points.items():
+                points = [point for point in points if tuple(point) not in removed_set]
+                if points:
+                    self.cov_manager.points[key] = points
+                else:
+                    del self.cov_manager.points[key]
+
+        # forget their readings
+        with mem.readings.batch():
+            for point in removed:
+                mem.readings.remove(point[4])
+
+        # read the new points now rather than waiting for the next sweep
+        if self.is_busy and added:
+            for point in added:
+                self.get_address(point[0])
+                self.requeue(point[0], [point])
+            deferred(self.fill_window)
+
+    def fill_window(self):
+        if _debug: PrairieDog._debug("fill_window")
+
+        # count the devices that were passed over because they are busy
+        skipped = 0
+        now = _time()
+
+        while self.device_ring and (len(self.in_flight) < self.window):
+            # every device left in the ring is busy
+            if skipped >= len(self.device_ring):
+                break
+
+            addr = self.device_ring.popleft()
+            queue = self.device_queues[addr]
+
+            # nothing left to read from this device
+            if not queue:
+                del self.device_queues[addr]
+                continue
+
+            health = self.device_health[addr]
+            state = health.state(now)
+
+            # the device is not answering, skip the rest of its points
+            if state == DeviceHealth.OPEN:
+                if _debug: PrairieDog._debug("    - skipping %s", addr)
+                with mem.readings.batch():
+                    for point in queue:
+                        publish_reading(point, None)
+                del self.device_queues[addr]
+                continue
+
+            # this device has enough to do, is being probed, or has not said
+            # how big a request it takes yet
+            if (self.who_is_pending.get(self.device_address[addr], 0) > now) or \
+                    (self.device_in_flight.get(addr, 0) >= self.device_window) or \
+                    ((state == DeviceHealth.HALF_OPEN) and self.device_in_flight.get(addr, 0)):
+                self.device_ring.append(addr)
+                skipped += 1
+                continue
+
+            # send the next batch and put the device at the end of the line,
+            # a device coming out of back-off gets a single read to probe it
+            if state == DeviceHealth.HALF_OPEN:
+                if _debug: PrairieDog._debug("    - probing %s", addr)
+                health.probing = True
+                count = 1
+            else:
+                count = min(len(queue), self.batch_size(addr))
+            self.next_request([queue.popleft() for i in range(count)])
+            self.device_ring.append(addr)
+            skipped = 0
 
         # check to see if we're done
-        if not self.point_queue:
+        if self.is_busy and (not self.device_ring) and (not self.in_flight):
             if _debug: PrairieDog._debug("    - done")
 
-
-            # dump out the results
-            for request, response in zip(point_list, self.response_values):
-                mem.readings_from_counters[request[4]]=response
-
             # no longer busy
             self.is_busy = False
-            mem.sayac_okuma_flag=0
 
-            return
+    def next_request(self, points):
+        if _debug: PrairieDog._debug("next_request %r", points)
 
-        # get the next request
-        addr, obj_type, obj_inst, prop_id, program_id = self.point_queue.popleft()
+        addr = points[0][0]
 
-        # build a request
-        self._request = ReadPropertyRequest(
-            objectIdentifier=(obj_type, obj_inst),
-            propertyIdentifier=prop_id,
-            )
-        self._request.pduDestination = Address(addr)
-        if _debug: PrairieDog._debug("    - request: %r", self._request)
+        # build a request, one point is a plain read
+        if len(points) == 1:
+            addr, obj_type, obj_inst, prop_id, program_id = points[0]
+            request = ReadPropertyRequest(
+                objectIdentifier=(obj_type, obj_inst),
+                propertyIdentifier=prop_id,
+                )
+        else:
+            request = ReadPropertyMultipleRequest(
+                listOfReadAccessSpecs=[
+                    ReadAccessSpecification(
+                        objectIdentifier=(obj_type, obj_inst),
+                        listOfPropertyReferences=[PropertyReference(propertyIdentifier=prop_id)],
+                        )
+                    for addr, obj_type, obj_inst, prop_id, program_id in points
+                    ],
+                )
+        request.pduDestination = self.device_address[addr]
+
+        # pick the invoke ID here so the response can be matched to the points
+        request.apduInvokeID = self.smap.get_next_invoke_id(request.pduDestination)
+        if _debug: PrairieDog._debug("    - request: %r", request)
+
+        # wait and retry based on how the device has been doing
+        health = self.device_health[addr]
+        info = self.get_device_info(request.pduDestination)
+        info.retryTimeout = health.retry_timeout(self.smap.retryTimeout)
+        info.retryCount = health.retry_count(self.smap.retryCount)
+
+        # track it before sending, an abort may come back right away
+        self.in_flight[(request.pduDestination, request.apduInvokeID)] = (points, _time(), info.retryTimeout)
+        self.device_in_flight[addr] = self.device_in_flight.get(addr, 0) + 1
 
         # forward it along
-        BIPSimpleApplication.request(self, self._request)
+        BIPSimpleApplication.request(self, request)
 
     def confirmation(self, apdu):
         if _debug: PrairieDog._debug("confirmation %r", apdu)
 
-        if isinstance(apdu, Error):
-            if _debug: PrairieDog._debug("    - error: %r", apdu)
-            self.response_values.append(apdu)
-
-        elif isinstance(apdu, AbortPDU):
-            if _debug: PrairieDog._debug("    - abort: %r", apdu)
-            self.response_values.append(apdu)
-
-        elif (isinstance(self._request, ReadPropertyRequest)) and (isinstance(apdu, ReadPropertyACK)):
-            # find the datatype
-            datatype = get_datatype(apdu.objectIdentifier[0], apdu.propertyIdentifier)
-            if _debug: PrairieDog._debug("    - datatype: %r", datatype)
-            if not datatype:
-                raise TypeError, "unknown datatype"
-
-            # special case for array parts, others are managed by cast_out
-            if issubclass(datatype, Array) and (apdu.propertyArrayIndex is not None):
-                if apdu.propertyArrayIndex == 0:
-                    value = apdu.propertyValue.cast_out(Unsigned)
-                else:
-                    value = apdu.propertyValue.cast_out(datatype.subtype)
-            else:
-                value = apdu.propertyValue.cast_out(datatype)
+        # subscription requests are tracked by the manager
+        if self.cov_manager and self.cov_manager.confirmation(apdu):
+            return
+
+        # find the points this is the response for
+        entry = self.in_flight.pop((apdu.pduSource, apdu.apduInvokeID), None)
+        if not entry:
+            if _debug: PrairieDog._debug("    - no matching request")
+            return
+        points, sent_time, retry_timeout = entry
+        addr = points[0][0]
+        self.device_in_flight[addr] -= 1
+
+        # there is room in the window for another request
+        deferred(self.fill_window)
+
+        # no response at all counts against the device, anything else means
+        # it is alive, but the round trip only counts if it wasn't retried
+        health = self.device_health[addr]
+        if isinstance(apdu, AbortPDU) and (apdu.apduAbortRejectReason == AbortReason.NORESPONSE):
+            if health.failure(_time()):
+                PrairieDog._warning("%s is not responding, skipping it for %d seconds", addr, health.backoff)
+        else:
+            rtt = (_time() - sent_time) * 1000.0
+            if rtt > retry_timeout:
+                rtt = None
+            health.success(rtt)
+
+        if isinstance(apdu, ReadPropertyMultipleACK):
+            self.read_multiple_ack(points, apdu)
+
+        elif isinstance(apdu, ReadPropertyACK):
+            value = cast_value(apdu.objectIdentifier, apdu.propertyIdentifier,
+                apdu.propertyArrayIndex, apdu.propertyValue)
             if _debug: PrairieDog._debug("    - value: %r", value)
 
             # save the value
-            self.response_values.append(value)
+            publish_reading(points[0], value)
 
-        # fire off another request
-        deferred(self.next_request)
+        elif (len(points) > 1) and isinstance(apdu, (Error, RejectPDU)):
+            PrairieDog._warning("%s rejected ReadPropertyMultiple (%s), using ReadProperty", addr, apdu)
 
+            # read them one at a time from now on
+            self.rpm_unsupported.add(addr)
+            self.requeue(addr, points)
 
-# DATABASE PARAMETERS ############################################################################
+        elif (len(points) > 1) and isinstance(apdu, AbortPDU) and apdu.apduSrv and \
+                (apdu.apduAbortRejectReason in (AbortReason.BUFFEROVERFLOW,
+                    AbortReason.SEGMENTATIONNOTSUPPORTED, AbortReason.APDUTOOLONG)):
+            if _debug: PrairieDog._debug("    - response too big: %r", apdu)
+
+            # the device can't send that much back, try smaller requests
+            info = self.get_device_info(self.device_address[addr])
+            info.maxApduLengthAccepted = RPM_ACK_HEADER_SIZE + (len(points) // 2) * RPM_RESULT_SIZE
+            if len(points) // 2 <= 1:
+                self.rpm_unsupported.add(addr)
+            self.requeue(addr, points)
+
+        else:
+            if _debug: PrairieDog._debug("    - error/reject/abort: %r", apdu)
+            with mem.readings.batch():
+                for point in points:
+                    publish_reading(point, apdu)
+
+    def read_multiple_ack(self, points, apdu):
+        if _debug: PrairieDog._debug("read_multiple_ack %r %r", points, apdu)
+
+        # the results come back by object
+        object_points = {}
+        for point in points:
+            object_points.setdefault((point[1], point[2]), []).append(point)
+
+        # all of the results go into one new snapshot
+        with mem.readings.batch():
+            for result in apdu.listOfReadAccessResults:
+                objectIdentifier = result.objectIdentifier
+                for element in result.listOfResults:
+                    if element.readResult.propertyAccessError:
+                        value = element.readResult.propertyAccessError
+                    else:
+                        value = cast_value(objectIdentifier, element.propertyIdentifier,
+                            element.propertyArrayIndex, element.readResult.propertyValue)
+                    if _debug: PrairieDog._debug("    - %r %r: %r", objectIdentifier, element.propertyIdentifier, value)
+
+                    # save the value
+                    for point in object_points.get(objectIdentifier, ()):
+                        if point[3] == element.propertyIdentifier:
+                            publish_reading(point, value)
+
+
+#
+#   COVSubscriptionManager
+#
+
+# subscriptions are renewed when less than this part of the lifetime is left
+COV_RENEW_MARGIN = 0.25
+
+@bacpypes_debugging
+class COVSubscriptionManager(RecurringTask):
+
+    def __init__(self, app, lifetime, interval=60, process_id=1):
+        if _debug: COVSubscriptionManager._debug("__init__ %r %r %r %r", app, lifetime, interval, process_id)
+        RecurringTask.__init__(self, interval * 1000)
+
+        # the application sends the requests and passes the notifications
+        self.app = app
+        app.cov_manager = self
+
+        # subscription parameters, lifetime is in seconds
+        self.lifetime = lifetime
+        self.process_id = process_id
+
+        # the points of each object and when its subscription expires, the
+        # key is the device address and the object identifier
+        self.points = {}
+        self.expires = {}
+
+        # subscriptions waiting to be sent and sent waiting for an ack
+        self.queue = deque()
+        self.queued = set()
+        self.pending = {}
+
+        # devices that refused a subscription are polled
+        self.refused = set()
+
+        # install it
+        self.install_task()
+
+    def is_subscribed(self, point, now):
+        """Return true if the point gets its value from notifications."""
+        address = self.app.get_address(point[0])
+        return self.expires.get((address, (point[1], point[2])), 0) > now
+
+    def process_task(self):
+        if _debug: COVSubscriptionManager._debug("process_task")
+        global point_list
+
+        now = _time()
+        renew_time = now + (self.lifetime * COV_RENEW_MARGIN)
+
+        # find the subscriptions that are missing or about to expire
+        self.points = {}
+        for point in point_list:
+            addr = point[0]
+            if addr in self.refused:
+                continue
+
+            key = (self.app.get_address(addr), (point[1], point[2]))
+            if key not in self.points:
+                self.points[key] = []
+                if (self.expires.get(key, 0) < renew_time) and (key not in self.queued):
+                    self.queue.append(key)
+                    self.queued.add(key)
+            self.points[key].append(point)
+
+        # stop tracking objects that are no longer in the list
+        for key in self.expires.keys():
+            if key not in self.points:
+                del self.expires[key]
+
+        self.send_subscriptions()
+
+    def send_subscriptions(self):
+        if _debug: COVSubscriptionManager._debug("send_subscriptions")
+
+        # share the window with the poller
+        while self.queue and (len(self.pending) < self.app.window):
+            address, objectIdentifier = key = self.queue.popleft()
+            self.queued.discard(key)
+            if (key not in self.points) or (str(address) in self.refused):
+                continue
+
+            request = SubscribeCOVRequest(
+                subscriberProcessIdentifier=self.process_id,
+                monitoredObjectIdentifier=objectIdentifier,
+                issueConfirmedNotifications=False,
+                lifetime=self.lifetime,
+                )
+            request.pduDestination = address
+            request.apduInvokeID = self.app.smap.get_next_invoke_id(address)
+            if _debug: COVSubscriptionManager._debug("    - request: %r", request)
+
+            # track it before sending, an abort may come back right away
+            self.pending[(address, request.apduInvokeID)] = (key, _time())
+
+            # forward it along
+            BIPSimpleApplication.request(self.app, request)
+
+    def confirmation(self, apdu):
+        """Return true if this is the response to a subscription request."""
+        entry = self.pending.pop((apdu.pduSource, apdu.apduInvokeID), None)
+        if not entry:
+            return False
+        if _debug: COVSubscriptionManager._debug("confirmation %r", apdu)
+
+        key, sent_time = entry
+        address, objectIdentifier = key
+
+        # room for the next one
+        deferred(self.send_subscriptions)
+
+        if isinstance(apdu, SimpleAckPDU):
+            self.expires[key] = sent_time + self.lifetime
+
+        elif isinstance(apdu, (Error, RejectPDU)) or \
+                (isinstance(apdu, AbortPDU) and apdu.apduSrv):
+            if str(address) not in self.refused:
+                COVSubscriptionManager._warning("%s refused a COV subscription (%s), polling it", address, apdu)
+
+            # poll everything on this device
+            self.refused.add(str(address))
+            for key in self.expires.keys():
+                if key[0] == address:
+                    del self.expires[key]
+
+        else:
+            if _debug: COVSubscriptionManager._debug("    - no response: %r", apdu)
+
+        return True
+
+    def notification(self, apdu):
+        if _debug: COVSubscriptionManager._debug("notification %r", apdu)
 
-import sqlite3
+        key = (apdu.pduSource, apdu.monitoredObjectIdentifier)
+        points = self.points.get(key)
+        if not points:
+            if _debug: COVSubscriptionManager._debug("    - not subscribed")
+            return
+
+        # the device says how much longer the subscription has
+        if apdu.timeRemaining:
+            self.expires[key] = _time() + apdu.timeRemaining
+
+        for element in apdu.listOfValues:
+            for point in points:
+                if point[3] != element.propertyIdentifier:
+                    continue
+
+                value = cast_value(apdu.monitoredObjectIdentifier, element.propertyIdentifier,
+                    element.propertyArrayIndex, element.value)
+                if _debug: COVSubscriptionManager._debug("    - %s: %r", point[4], value)
+
+                publish_reading(point, value)
+
+#
+#   MeterDefinitionWatcher
+#
+
+@bacpypes_debugging
+class MeterDefinitionWatcher(RecurringTask):
+
+    def __init__(self, app, path, interval):
+        """Reload the definitions when the file changes and pass the point
+        changes to the app, None when this process does not poll."""
+        if _debug: MeterDefinitionWatcher._debug("__init__ %r %r %r", app, path, interval)
+        RecurringTask.__init__(self, interval * 1000)
+
+        self.app = app
+        self.path = path
+        self.stat = meterdefs.file_stat(path)
+
+        # install it
+        self.install_task()
+
+    def process_task(self):
+        if _debug: MeterDefinitionWatcher._debug("process_task")
+        global point_list, point_set, dict_mako
+
+        # check to see if the file changed
+        stat = meterdefs.file_stat(self.path)
+        if (stat is None) or (stat == self.stat):
+            return
+
+        # the file may be in the middle of being saved, try again next time
+        try:
+            new_point_list, new_dict_mako = meterdefs.load_definitions(self.path)
+        except Exception, err:
+            MeterDefinitionWatcher._warning("unable to reload %s: %s", self.path, err)
+            return
+        self.stat = stat
+
+        added, removed = meterdefs.diff_points(point_list, new_point_list)
+        if added or removed:
+            MeterDefinitionWatcher._info("%s reloaded, %d points added, %d removed", self.path, len(added), len(removed))
+
+        # swap in the new definitions, the web threads pick them up on the
+        # next request
+        point_list = new_point_list
+        point_set = set(tuple(point) for point in new_point_list)
+        dict_mako = new_dict_mako
+
+        if self.app and (added or removed):
+            self.app.update_points(added, removed)
+
+
+# DATABASE PARAMETERS ############################################################################
 
 sqlite_file = 'tenantdata.sqlite'    # name of the sqlite database file
-table_name = 'tenant_counter'   # name of the table to be created
-date_col = 'date' # name of the date column
-time_col = 'time'# name of the time column
-date_time_col = 'date_time' # name of the date & time column
-id_col = 'id' # name of the id column
-sayacdegeri_col = 'sayacdeger' # name of the counter value column
 
 # COUNTER STORE VALUES ############################################################################
 
-def sayac_yaz():
+import meterdb
+import meterbilling
+import meterseries
+import meterjournal
 
-    threading.Timer(3600, sayac_yaz).start()
+recorder = meterdb.Recorder(sqlite_file)
 
-    if (mem.skip_first_save==1):
-        mem.skip_first_save=0
-        return
+# billing readings by meter and day
+daily_cache = meterdb.DailyCache(sqlite_file)
 
-    print "Sayaclari kaydediyor"
+# called after every save
+mem.on_save = [daily_cache.invalidate]
 
-    save_time = datetime.now()
+# days of raw readings to keep, the daily rollup is kept regardless
+mem.retention_days = 0
+mem.prune_date = None
 
-    if mem.sayac_okuma_flag==0:
-        save_dict=mem.readings_from_counters
+# minutes between saves, on the boundaries of the local clock
+RECORD_INTERVAL = 60
 
-    # Connecting to the database file
-    conn2 = sqlite3.connect('tenantdata.sqlite')
-    c2 = conn2.cursor()
+def sayac_yaz(save_time, save_dict, seq=None):
 
-    for idx in save_dict:
-        sayac_value=save_dict[idx]
-        actual_counter_id=idx
-        if isinstance(sayac_value, float):
-            # insert a new row with the current date and time, e.g., 2014-03-06
-            c2.execute('''INSERT INTO tenant_counter VALUES(?,?,?,?,?)''' , (actual_counter_id, save_time.strftime('%Y-%m-%d'), save_time.strftime('%H:%M:%S'), save_time.strftime('%Y-%m-%d %H:%M:%S'), sayac_value))
-        else:
-            # insert a new row with the current date and time, e.g., 2014-03-06
-            c2.execute('''INSERT INTO tenant_counter VALUES(?,?,?,?,?)''' , (actual_counter_id, save_time.strftime('%Y-%m-%d'), save_time.strftime('%H:%M:%S'), save_time.strftime('%Y-%m-%d %H:%M:%S'), 'Error!'))
-    conn2.commit()
-    conn2.close()
+    print "Sayaclari kaydediyor"
+
+    # one transaction on the long lived connection, this is the only part
+    # the journal retries if it fails
+    recorder.save(save_dict, save_time, seq)
+
+    # the rest is done once, a failure is logged and does not undo the save
+    try:
+        for fn in mem.on_save:
+            fn()
+    except Exception, err:
+        _log.exception("save hook failed: %s", err)
+
+    # once a day drop the raw readings that are too old
+    if mem.retention_days and (save_time.date() != mem.prune_date):
+        try:
+            recorder.prune(save_time - timedelta(days=mem.retention_days))
+            mem.prune_date = save_time.date()
+        except Exception, err:
+            _log.exception("prune failed, trying again next save: %s", err)
     return
 
+#
+#   RecorderTask
+#
+
+@bacpypes_debugging
+class RecorderTask(ClockAlignedTask):
+
+    def __init__(self, minutes=RECORD_INTERVAL, journal_path=meterjournal.JOURNAL_FILE):
+        if _debug: RecorderTask._debug("__init__ %r %r", minutes, journal_path)
+        ClockAlignedTask.__init__(self, minutes * 60 * 1000)
+
+        # saves go into the journal first, what is left from the last run
+        # is saved before anything new
+        self.journal = meterjournal.Journal(journal_path, recorder.checkpoint())
+
+        # the database work is done by a thread of its own so a slow or
+        # locked database never holds up the BACnet loop
+        self.flusher = meterjournal.JournalFlusher(self.journal, self.save_record)
+        self.flusher.start()
+
+        # install it
+        self.install_task()
+
+    def process_task(self):
+        # stamped with the boundary so the samples line up with billing days
+        save_time = datetime.fromtimestamp(self.taskTime)
+        if _debug: RecorderTask._debug("process_task %r", save_time)
+
+        # the latest reading of every point, even in the middle of a sweep,
+        # without holding up the poller
+        version, save_dict = mem.readings.snapshot()
+
+        self.journal.append(self.taskTime, save_dict)
+
+    def save_record(self, record):
+        sayac_yaz(datetime.fromtimestamp(record.save_time), record.readings, record.seq)
+
 
 # WEB APP ############################################################################
 
@@ -270,6 +927,60 @@ conf = {'/media':
                 }
         }
 
+def format_readings(readings):
+    """Return the readings as the web page shows them, None for the points
+    that have been removed."""
+    dict_counter_readings = {}
+    for meterid in readings:
+        reading = readings[meterid]
+        if reading is None:
+            dict_counter_readings[meterid] = None
+        elif reading.quality == meterreadings.GOOD:
+            dict_counter_readings[meterid] = "%.2f kwh" % (reading.value/1000)
+        else:
+            dict_counter_readings[meterid] = 'Error!'
+
+    return dict_counter_readings
+
+def encode_readings(readings):
+    """Return the JSON of the readings for the web page."""
+    return json.dumps(format_readings(readings))
+
+# web server worker threads
+WEB_THREAD_POOL = 50
+
+# seconds between keep alive comments on an idle event stream
+STREAM_KEEPALIVE = 15.0
+
+# each open stream holds a worker thread, keep the rest for the other pages
+MAX_STREAMS = WEB_THREAD_POOL // 2
+stream_slots = threading.Semaphore(MAX_STREAMS)
+
+def parse_event_id(event_id):
+    """Return the version in a Last-Event-ID if it is from this run of the
+    application, otherwise None."""
+    try:
+        token, version = event_id.split('-')
+        if token == mem.readings.token:
+            return int(version)
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+sayac_json = meterreadings.EncodedSnapshot(mem.readings, encode_readings)
+
+def group_meters(grs, busbar=None):
+    """Return the program ids of the meters in a grs, or in one busbar of
+    it, matching the keys from the spreadsheet as text."""
+    meter_ids = []
+    for grs_key, busbars in dict_mako.iteritems():
+        if unicode(grs_key) != grs:
+            continue
+        for busbar_key, program_ids in busbars.iteritems():
+            if (busbar is None) or (unicode(busbar_key) == busbar):
+                meter_ids.extend(program_ids)
+    return meter_ids
+
 class AjaxApp(object):
     @cherrypy.expose
     def index(self):
@@ -280,72 +991,86 @@ class AjaxApp(object):
     @cherrypy.expose
     def sayac_oku(self):
 
-        if mem.sayac_okuma_flag==0:
-            temp_dict={}
-            temp_dict=mem.readings_from_counters
-    
-            for meterid in temp_dict:
-                metervalue=mem.readings_from_counters[meterid]
-                if isinstance(metervalue, float):
-                    mem.dict_counter_readings[meterid] = "%.2f kwh" % (metervalue/1000)
-                else:
-                    mem.dict_counter_readings[meterid] = 'Error!'
-
-
+        # encoded once for each change to the readings
+        version, etag, body = sayac_json.get()
 
         cherrypy.response.headers['Content-Type'] = 'application/json'
-        cherrypy.response.headers['Expires'] = 'Sun, 19 Nov 1978 05:00:00 GMT'
-        cherrypy.response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0'
-        cherrypy.response.headers['Pragma'] = 'no-cache'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.response.headers['ETag'] = etag
+
+        # the browser already has this one
+        if_none_match = cherrypy.request.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            cherrypy.response.status = 304
+            return ''
 
-        return json.dumps(mem.dict_counter_readings)
+        return body
 
     @cherrypy.expose
-    def submit(self, main_id, unitprice, val1, val2):
+    def sayac_stream(self):
 
-        # Connecting to the database file
-        conn = sqlite3.connect(sqlite_file)
-        c = conn.cursor()
-        # Retrieve all IDs of entries between 2 date_times
-        c.execute("SELECT {countervalue} FROM {tn} WHERE ({cn} = '{xn}') & ({idn} = '{sn}') ".\
-        format(countervalue=sayacdegeri_col, tn=table_name, cn=date_col, xn=val1, idn=id_col, sn=main_id))
-
-        readings_at_first_date=[]
-        readings_at_first_date=c.fetchall()
-        if not readings_at_first_date:
-            first_index=[0.0,]
-        else:
-            first_index=max(readings_at_first_date)
+        # too many dashboards already, they fall back to polling
+        if not stream_slots.acquire(False):
+            cherrypy.response.status = 503
+            cherrypy.response.headers['Retry-After'] = '60'
+            return ''
 
-        # if list is empty, give it 0 as default
-        if first_index[0]=='Error!':
-            first_index=[0.0,]
+        # given back when the request ends, whether or not the body was
+        # ever sent, a HEAD request or an error never runs the generator
+        cherrypy.request.hooks.attach('on_end_request', stream_slots.release)
 
-        conn.commit()
-        c.execute("SELECT {countervalue} FROM {tn} WHERE ({cn} = '{xn}') & ({idn} = '{sn}') ".\
-        format(countervalue=sayacdegeri_col, tn=table_name, cn=date_col, xn=val2, idn=id_col, sn=main_id))
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
 
-        readings_at_last_date=[]
-        readings_at_last_date=c.fetchall()
-        if not readings_at_last_date:
-            last_index=[0.0,]
-        else:
-            last_index=max(readings_at_last_date)
+        # pick up where the client left off
+        version = parse_event_id(cherrypy.request.headers.get('Last-Event-ID'))
+
+        def events(version):
+            # how long to wait before reconnecting
+            yield 'retry: 5000\n\n'
+
+            while True:
+                if version is None:
+                    changed = None
+                else:
+                    version, changed = mem.readings.changes_since(version)
+
+                # start over with everything
+                if changed is None:
+                    version, changed = mem.readings.snapshot()
+
+                if changed:
+                    yield 'id: %s-%d\ndata: %s\n\n' % (mem.readings.token, version,
+                        json.dumps(format_readings(changed)))
+                else:
+                    # a write to a closed connection ends the stream
+                    yield ': keepalive\n\n'
 
-        # if list is empty, give it 0 as default
-        if last_index[0]=='Error!':
-            last_index=[0.0,]
+                mem.readings.wait(version, STREAM_KEEPALIVE)
 
-        conn.commit()
-        conn.close()
+        return events(version)
 
-        difference=abs((first_index[0])-(last_index[0]))
+    sayac_stream._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def submit(self, main_id, unitprice, val1, val2):
+
+        # the largest good reading of each day, 0.0 if there are none
+        first_index = daily_cache.max_reading(main_id, val1)
+        last_index = daily_cache.max_reading(main_id, val2)
+
+        if first_index is None:
+            first_index = 0.0
+        if last_index is None:
+            last_index = 0.0
+
+        difference=abs(first_index-last_index)
         fatura= ((difference/1000) * int(unitprice))
 
         #kwh cinsinden degerleri hesapla ve gonder
         difference_str="%.2f kwh" % (difference/1000)
-        first_index_str="%.2f kwh" % (first_index[0]/1000)
-        last_index_str="%.2f kwh" % (last_index[0]/1000)
+        first_index_str="%.2f kwh" % (first_index/1000)
+        last_index_str="%.2f kwh" % (last_index/1000)
 
         r = {'1':first_index_str, '2': last_index_str, '3': difference_str, '4': str(fatura)}
 
@@ -356,6 +1081,76 @@ class AjaxApp(object):
 
         return json.dumps(r)
 
+    @cherrypy.expose
+    def billing(self, val1, val2, unitprice=None, group='meter'):
+
+        if unitprice is None:
+            unitprice = data['unitprice']
+        if group not in ('meter', 'grs', 'busbar'):
+            raise cherrypy.HTTPError(400, "group must be meter, grs or busbar")
+        try:
+            unitprice = float(unitprice)
+            meterdb.day_range(val1)
+            meterdb.day_range(val2)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "bad unit price or dates")
+
+        # every meter for the period in one pass over the daily rollup
+        conn = meterdb.connect(sqlite_file)
+        try:
+            report = meterbilling.billing_report(conn, val1, val2, unitprice, dict_mako, group)
+        finally:
+            conn.close()
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Expires'] = '0'
+        cherrypy.response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate'
+        cherrypy.response.headers['Pragma'] = 'no-cache'
+
+        return json.dumps(report)
+
+    @cherrypy.expose
+    def series(self, val1, val2, main_id=None, grs=None, busbar=None, points=300, method='minmax'):
+
+        if main_id:
+            meter_ids = [main_id]
+        elif grs:
+            meter_ids = group_meters(grs, busbar)
+        else:
+            raise cherrypy.HTTPError(400, "main_id or grs is required")
+        if not meter_ids:
+            raise cherrypy.HTTPError(404, "no meters")
+        if method not in meterseries.METHODS:
+            raise cherrypy.HTTPError(400, "method must be one of %s" % (', '.join(meterseries.METHODS),))
+        try:
+            points = max(1, int(points))
+            start = meterdb.day_range(val1)[0]
+            end = meterdb.day_range(val2)[1]
+        except ValueError:
+            raise cherrypy.HTTPError(400, "bad points or dates")
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+
+        def stream():
+            conn = meterdb.connect(sqlite_file)
+            try:
+                rows = meterseries.read_series(conn, meter_ids, start, end)
+
+                # one point per chunk, the whole series is never in a string
+                yield '{"method": %s, "points": [' % (json.dumps(method),)
+                separator = ''
+                for point in meterseries.downsample(rows, start, end, points, method):
+                    yield separator + json.dumps(point)
+                    separator = ','
+                yield ']}'
+            finally:
+                conn.close()
+
+        return stream()
+
+    series._cp_config = {'response.stream': True}
+
     @cherrypy.expose
     def changeState(self,item1):
         data['unitprice']=item1
@@ -385,13 +1180,42 @@ class AjaxApp(object):
 def open_page():
     pass
 
-cherrypy.engine.subscribe('start', open_page)
-cherrypy.tree.mount(AjaxApp(), '/', config=conf)
-cherrypy.engine.start()
+def start_web():
+    cherrypy.engine.subscribe('start', open_page)
+    # the readings are shared without locks, so more workers only cost memory,
+    # and each open event stream keeps one of them
+    cherrypy.config.update({'server.thread_pool': WEB_THREAD_POOL})
+    cherrypy.tree.mount(AjaxApp(), '/', config=conf)
+    cherrypy.engine.start()
 
 # Start Recorder ###################################################################################################################################
 
-sayac_yaz()
+def start_recorder(minutes=RECORD_INTERVAL, journal_path=meterjournal.JOURNAL_FILE):
+    RecorderTask(minutes, journal_path)
+
+# PROCESSES ########################################################################################################################################
+
+import metershm
+import metersupervisor
+
+# everything in one process, or one part of it
+ROLES = ('all', 'supervisor', 'poller', 'recorder', 'web')
+
+# what the supervisor runs
+SUPERVISED_ROLES = ('poller', 'recorder', 'web')
+
+def supervisor_args(argv):
+    """Return the command line without the role, for the children."""
+    child_args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--role':
+            skip = True
+        elif not arg.startswith('--role='):
+            child_args.append(arg)
+    return child_args
 
 ####################################################################################################################################################
 
@@ -403,12 +1227,111 @@ try:
     # parse the command line arguments
     parser = ConfigArgumentParser(description=__doc__)
 
+    # how many reads can be going on at the same time
+    parser.add_argument('--window', type=int,
+        help="maximum number of requests in flight",
+        default=1,
+        )
+    parser.add_argument('--device-window', type=int,
+        help="maximum number of requests in flight to one device",
+        default=1,
+        )
+    parser.add_argument('--timer-wheel', action='store_true',
+        help="keep the request timeouts in a timer wheel, for wide windows",
+        default=False,
+        )
+
+    # subscribe for changes rather than polling
+    parser.add_argument('--cov', action='store_true',
+        help="subscribe to COV notifications, poll devices that refuse",
+        default=False,
+        )
+    parser.add_argument('--cov-lifetime', type=int,
+        help="COV subscription lifetime in seconds",
+        default=600,
+        )
+
+    # pick up changes to the meter definitions without a restart
+    parser.add_argument('--reload-interval', type=int,
+        help="seconds between checks for a new MeterDefinitions.xls, zero to disable",
+        default=30,
+        )
+
+    # run the parts as separate processes
+    parser.add_argument('--role',
+        help="part of the application to run in this process",
+        choices=ROLES,
+        default='all',
+        )
+    parser.add_argument('--shm',
+        help="file shared by the processes for the current readings",
+        default=metershm.SHARED_READINGS_FILE,
+        )
+    parser.add_argument('--shm-slots', type=int,
+        help="number of points the shared readings file has room for",
+        default=metershm.SHARED_READINGS_SLOTS,
+        )
+
+    # when to save the readings
+    parser.add_argument('--record-interval', type=int,
+        help="minutes between saves, aligned to the clock, like 15 or 60",
+        default=RECORD_INTERVAL,
+        )
+
+    parser.add_argument('--journal',
+        help="file the saves go into before the database",
+        default=meterjournal.JOURNAL_FILE,
+        )
+
+    # raw readings are only needed for a while, billing uses the daily rollup
+    parser.add_argument('--retention-days', type=int,
+        help="days of raw readings to keep, whole months are dropped, zero to keep them all",
+        default=0,
+        )
+
     # now parse the arguments
     args = parser.parse_args()
 
     if _debug: _log.debug("initialization")
     if _debug: _log.debug("    - args: %r", args)
 
+    mem.retention_days = args.retention_days
+
+    # start the parts and let them take care of themselves
+    if args.role == 'supervisor':
+        _log.debug("supervising")
+        metersupervisor.Supervisor(os.path.abspath(__file__), SUPERVISED_ROLES,
+            supervisor_args(sys.argv[1:])).run()
+        sys.exit(0)
+
+    # fail before anything starts if the database needs migrating
+    if args.role in ('all', 'recorder', 'web'):
+        recorder.get_connection()
+
+    # the other processes follow the readings of the poller
+    if args.role in ('recorder', 'web'):
+        mirror = metershm.SharedReadingsMirror(args.shm, mem.readings, on_saved=daily_cache.invalidate)
+        mem.on_save.append(mirror.mark_saved)
+        mirror.start()
+
+    if args.role in ('all', 'web'):
+        start_web()
+    if args.role in ('all', 'recorder'):
+        start_recorder(args.record_interval, args.journal)
+
+    if args.role == 'web':
+        # the groups are used by the pages, keep them up to date
+        if args.reload_interval:
+            MeterDefinitionWatcher(None, METER_DEFINITIONS, args.reload_interval)
+        try:
+            run()
+        finally:
+            cherrypy.engine.exit()
+        sys.exit(0)
+    if args.role == 'recorder':
+        run()
+        sys.exit(0)
+
     # make a device object
     this_device = LocalDeviceObject(
         objectName=args.ini.objectname,
@@ -428,8 +1351,31 @@ try:
     # set the property value to be just the bits
     this_device.protocolServicesSupported = pss.value
 
+    # lots of requests in flight means lots of timers
+    if args.timer_wheel:
+        enable_timer_wheel()
+
     # make a dog
-    this_application = PrairieDog(240, this_device, args.ini.address)
+    this_application = PrairieDog(240, args.window, args.device_window, this_device, args.ini.address)
+
+    # find out how big a request each device takes before the first sweep
+    this_application.discover(point_list)
+
+    # pass the readings on to the other processes, the size does not depend
+    # on the point list so a reload or a restart does not resize the file
+    if args.role == 'poller':
+        if len(point_list) > args.shm_slots:
+            _log.warning("%d points and only %d shared slots, raise --shm-slots", len(point_list), args.shm_slots)
+        shared = metershm.SharedReadings(args.shm, args.shm_slots)
+        mem.readings.listeners.append(shared.publish_changes)
+
+    # keep the points up to date with notifications
+    if args.cov:
+        COVSubscriptionManager(this_application, args.cov_lifetime)
+
+    # watch for changes to the point list
+    if args.reload_interval:
+        MeterDefinitionWatcher(this_application, METER_DEFINITIONS, args.reload_interval)
 
     _log.debug("running")
 
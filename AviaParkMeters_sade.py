@@ -191,18 +191,15 @@ class PrairieDog(BIPSimpleApplication, RecurringTask):
 
 # DATABASE PARAMETERS ############################################################################
 
-import sqlite3
+import meterdb
+import meterreadings
 
 sqlite_file = 'tenantdata.sqlite'    # name of the sqlite database file
-table_name = 'tenant_counter'   # name of the table to be created
-date_col = 'date' # name of the date column
-time_col = 'time'# name of the time column
-date_time_col = 'date_time' # name of the date & time column
-id_col = 'id' # name of the id column
-sayacdegeri_col = 'sayacdeger' # name of the counter value column
 
 # COUNTER STORE VALUES ############################################################################
 
+recorder = meterdb.Recorder(sqlite_file)
+
 def sayac_yaz():
 
     threading.Timer(3600, sayac_yaz).start()
@@ -218,52 +215,16 @@ def sayac_yaz():
     if mem.sayac_okuma_flag==0:
         save_dict=mem.readings_from_counters
 
-    # Connecting to the database file
-    conn2 = sqlite3.connect('tenantdata.sqlite')
-    c2 = conn2.cursor()
-
+    readings = {}
     for idx in save_dict:
         sayac_value=save_dict[idx]
-        actual_counter_id=idx
         if isinstance(sayac_value, float):
-            # insert a new row with the current date and time, e.g., 2014-03-06
-            c2.execute('''INSERT INTO tenant_counter VALUES(?,?,?,?,?)''' , (actual_counter_id, save_time.strftime('%Y-%m-%d'), save_time.strftime('%H:%M:%S'), save_time.strftime('%Y-%m-%d %H:%M:%S'), sayac_value))
+            readings[idx] = meterreadings.Reading(sayac_value, None, meterreadings.GOOD)
         else:
-            # insert a new row with the current date and time, e.g., 2014-03-06
-            c2.execute('''INSERT INTO tenant_counter VALUES(?,?,?,?,?)''' , (actual_counter_id, save_time.strftime('%Y-%m-%d'), save_time.strftime('%H:%M:%S'), save_time.strftime('%Y-%m-%d %H:%M:%S'), 'Error!'))
-
-    conn2.commit()
-
-    if (save_time.hour==23):
-
-        print "Sayaclari sadelestiriyor"
-
-        today=save_time.strftime('%Y-%m-%d')
-
-        cursor1 = conn2.cursor()
-        cursor2 = conn2.cursor()
-
-        cursor1.execute('''DELETE FROM tenant_counter
-        WHERE EXISTS (SELECT * FROM tenant_counter AS r
-        WHERE r.id = tenant_counter.id AND r.date = '{xn}' 
-        AND r.sayacdeger > tenant_counter.sayacdeger)'''.\
-                   format(xn=today))
+            readings[idx] = meterreadings.Reading(None, None, meterreadings.ERROR)
 
-        conn2.commit()
-        
-        cursor2.execute('''delete   from tenant_counter
-        where    rowid not in
-                 (
-                 select  min(rowid)
-                 from    tenant_counter AS r
-                 where r.id = tenant_counter.id
-                 and r.date = '{xn}'
-                 and r.sayacdeger = tenant_counter.sayacdeger)'''.\
-                   format(xn=today))
-
-        print "Sayaclari sadelestirildi"
-    conn2.commit()
-    conn2.close()
+    # the daily rollup is kept up to date as the rows go in
+    recorder.save(readings, save_time)
     return
 
 
@@ -334,49 +295,26 @@ class AjaxApp(object):
     @cherrypy.expose
     def submit(self, main_id, unitprice, val1, val2):
 
-        # Connecting to the database file
-        conn = sqlite3.connect(sqlite_file)
-        c = conn.cursor()
-        # Retrieve all IDs of entries between 2 date_times
-        c.execute("SELECT {countervalue} FROM {tn} WHERE ({cn} = '{xn}') & ({idn} = '{sn}') ".\
-        format(countervalue=sayacdegeri_col, tn=table_name, cn=date_col, xn=val1, idn=id_col, sn=main_id))
-
-        readings_at_first_date=[]
-        readings_at_first_date=c.fetchall()
-        if not readings_at_first_date:
-            first_index=[0.0,]
-        else:
-            first_index=max(readings_at_first_date)
-
-        # if list is empty, give it 0 as default
-        if first_index[0]=='Error!':
-            first_index=[0.0,]
-
-        conn.commit()
-        c.execute("SELECT {countervalue} FROM {tn} WHERE ({cn} = '{xn}') & ({idn} = '{sn}') ".\
-        format(countervalue=sayacdegeri_col, tn=table_name, cn=date_col, xn=val2, idn=id_col, sn=main_id))
-
-        readings_at_last_date=[]
-        readings_at_last_date=c.fetchall()
-        if not readings_at_last_date:
-            last_index=[0.0,]
-        else:
-            last_index=max(readings_at_last_date)
-
-        # if list is empty, give it 0 as default
-        if last_index[0]=='Error!':
-            last_index=[0.0,]
+        # the largest good reading of each day, 0.0 if there are none
+        conn = meterdb.connect(sqlite_file)
+        try:
+            first_index = meterdb.max_reading(conn, main_id, val1)
+            last_index = meterdb.max_reading(conn, main_id, val2)
+        finally:
+            conn.close()
 
-        conn.commit()
-        conn.close()
+        if first_index is None:
+            first_index = 0.0
+        if last_index is None:
+            last_index = 0.0
 
-        difference=abs((first_index[0])-(last_index[0]))
+        difference=abs(first_index-last_index)
         fatura= ((difference/1000) * int(unitprice))
 
         #kwh cinsinden degerleri hesapla ve gonder
         difference_str="%.2f kwh" % (difference/1000)
-        first_index_str="%.2f kwh" % (first_index[0]/1000)
-        last_index_str="%.2f kwh" % (last_index[0]/1000)
+        first_index_str="%.2f kwh" % (first_index/1000)
+        last_index_str="%.2f kwh" % (last_index/1000)
 
         r = {'1':first_index_str, '2': last_index_str, '3': difference_str, '4': str(fatura)}
 
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+"""
+Asyncio
+
+Run bacpypes inside an asyncio (or trollius) event loop instead of with
+core.run().  The driver runs the tasks of the TaskManager and the deferred
+functions from loop callbacks and gives the asyncore dispatchers to the loop
+as readers and writers, so the UDP and TCP directors work unchanged.
+
+    loop = asyncio.get_event_loop()
+    driver = AsyncioDriver(loop)
+    driver.start()
+
+    requests = AsyncioRequests(this_application, driver)
+    futures = [requests.request(apdu) for apdu in apdus]
+    asyncio.gather(*futures).add_done_callback(show_results)
+
+    loop.run_forever()
+
+The confirmations of these requests resolve their futures, the others go
+on to the application as usual, so it does not need any changes.
+"""
+
+import asyncore
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from debugging import bacpypes_debugging, ModuleLogger
+
+import core
+from task import TaskManager
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+#
+#   AsyncioDriver
+#
+
+@bacpypes_debugging
+class AsyncioDriver(object):
+
+    def __init__(self, loop=None):
+        if _debug: AsyncioDriver._debug("__init__ %r", loop)
+
+        self.loop = loop or asyncio.get_event_loop()
+
+        # reference the task manager (a singleton), core.stop() uses it
+        self.taskManager = core.taskManager = TaskManager()
+
+        # fd -> dispatcher given to the loop
+        self.readers = {}
+        self.writers = {}
+
+        # the next call of step()
+        self.handle = None
+        self.woken = False
+
+    def start(self):
+        """Start running the tasks and dispatchers from the loop."""
+        if _debug: AsyncioDriver._debug("start")
+
+        core.running = True
+        self.wake()
+
+    def stop(self):
+        """Stop running, the dispatchers are taken out of the loop."""
+        if _debug: AsyncioDriver._debug("stop")
+
+        core.running = False
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+        for fd in self.readers:
+            self.loop.remove_reader(fd)
+        for fd in self.writers:
+            self.loop.remove_writer(fd)
+        self.readers = {}
+        self.writers = {}
+
+    def wake(self):
+        """Run step() as soon as the loop gets to it, call this after doing
+        something that may install a task or have something to send."""
+        if self.woken:
+            return
+        if self.handle:
+            self.handle.cancel()
+        self.woken = True
+        self.handle = self.loop.call_soon(self.step)
+
+    def step(self):
+        self.handle = None
+        self.woken = False
+
+        # core.stop() was called
+        if not core.running:
+            self.stop()
+            return
+
+        delta = None
+        try:
+            # run the tasks that are due and what they defer
+            while True:
+                task, delta = self.taskManager.get_next_task()
+                if task:
+                    self.taskManager.process_task(task)
+                if core.pendingCalls:
+                    core.call_pending()
+                core.call_deferred()
+                if not task:
+                    break
+        except Exception, err:
+            AsyncioDriver._exception("an error has occurred: %s", err)
+
+        self.update()
+
+        # come back when the next task is due, a reader or a wake() may
+        # come first
+        if core.deferredFns or core.pendingCalls:
+            delta = 0.0
+        elif delta is None:
+            delta = core.SPIN
+        self.handle = self.loop.call_later(delta, self.step)
+
+    def update(self):
+        """Bring the loop readers and writers up to date with the socket map."""
+        socket_map = asyncore.socket_map
+
+        for fd, obj in socket_map.items():
+            # the same events asyncore.poll2() asks for
+            self.want(self.readers, fd, obj, obj.readable(),
+                self.loop.add_reader, self.loop.remove_reader, self.read)
+            self.want(self.writers, fd, obj, obj.writable() and not obj.accepting,
+                self.loop.add_writer, self.loop.remove_writer, self.write)
+
+        # dispatchers that have gone
+        for registered, remove in ((self.readers, self.loop.remove_reader),
+                (self.writers, self.loop.remove_writer)):
+            for fd in [fd for fd in registered if fd not in socket_map]:
+                remove(fd)
+                del registered[fd]
+
+    def want(self, registered, fd, obj, wanted, add, remove, callback):
+        current = registered.get(fd)
+        if wanted and (current is not obj):
+            if current is not None:
+                remove(fd)
+            add(fd, callback, obj)
+            registered[fd] = obj
+        elif (not wanted) and (current is not None):
+            remove(fd)
+            del registered[fd]
+
+    def read(self, obj):
+        asyncore.read(obj)
+        self.wake()
+
+    def write(self, obj):
+        asyncore.write(obj)
+        self.wake()
+
+#
+#   AsyncioRequests
+#
+
+@bacpypes_debugging
+class AsyncioRequests(object):
+
+    def __init__(self, app, driver):
+        if _debug: AsyncioRequests._debug("__init__ %r %r", app, driver)
+
+        self.app = app
+        self.driver = driver
+
+        # (destination, invoke ID) -> future
+        self.futures = {}
+
+        # see the confirmations before the application does
+        self.app_confirmation = app.confirmation
+        app.confirmation = self.confirmation
+
+    def close(self):
+        """Give the confirmations back to the application, the requests that
+        have not been answered are cancelled."""
+        if _debug: AsyncioRequests._debug("close")
+
+        if self.app.confirmation == self.confirmation:
+            del self.app.confirmation
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+
+    def request(self, apdu):
+        """Send a confirmed request, return a future that has the ack, error,
+        reject or abort as its result."""
+        if _debug: AsyncioRequests._debug("request %r", apdu)
+
+        # pick the invoke ID here so the response can be matched to it
+        apdu.apduInvokeID = self.app.smap.get_next_invoke_id(apdu.pduDestination)
+
+        future = asyncio.Future(loop=self.driver.loop)
+        self.futures[(apdu.pduDestination, apdu.apduInvokeID)] = future
+
+        try:
+            self.app.request(apdu)
+        except Exception, err:
+            del self.futures[(apdu.pduDestination, apdu.apduInvokeID)]
+            future.set_exception(err)
+
+        # there is something to send and a timer to start
+        self.driver.wake()
+
+        return future
+
+    def confirmation(self, apdu):
+        """Resolve the future of a request, pass anything else on to the
+        application."""
+        future = self.futures.pop((apdu.pduSource, apdu.apduInvokeID), None)
+        if future is None:
+            self.app_confirmation(apdu)
+            return
+        if _debug: AsyncioRequests._debug("confirmation %r", apdu)
+
+        if not future.cancelled():
+            future.set_result(apdu)
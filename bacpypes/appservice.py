@@ -26,9 +26,10 @@ class DeviceInfo(DebugContents):
 
     _debug_contents = ('address', 'segmentationSupported'
         , 'maxApduLengthAccepted', 'maxSegmentsAccepted'
+        , 'retryTimeout', 'retryCount'
         )
     
-    def __init__(self, address=None, segmentationSupported='no-segmentation', maxApduLengthAccepted=1024, maxSegmentsAccepted=None):
+    def __init__(self, address=None, segmentationSupported='no-segmentation', maxApduLengthAccepted=1024, maxSegmentsAccepted=None, retryTimeout=None, retryCount=None):
         if address is None:
             pass
         elif isinstance(address, Address):
@@ -44,6 +45,8 @@ class DeviceInfo(DebugContents):
         self.segmentationSupported = segmentationSupported  # normally no segmentation
         self.maxApduLengthAccepted = maxApduLengthAccepted  # how big to divide up apdu's
         self.maxSegmentsAccepted = maxSegmentsAccepted      # limit on how many segments to recieve
+        self.retryTimeout = retryTimeout                    # how long to wait for a response, None for the default
+        self.retryCount = retryCount                        # how many times to send a request, None for the default
 
 #----------------------------------------------------------------------
 
@@ -64,6 +67,9 @@ ABORTED = 7
 @bacpypes_debugging
 class SSM(OneShotTask, DebugContents):
 
+    # the timer goes in the timer wheel when it is enabled
+    taskWheel = True
+
     transactionLabels = ['IDLE'
         , 'SEGMENTED_REQUEST', 'AWAIT_CONFIRMATION', 'AWAIT_RESPONSE'
         , 'SEGMENTED_RESPONSE', 'SEGMENTED_CONFIRMATION', 'COMPLETED', 'ABORTED'
@@ -270,6 +276,20 @@ class ClientSSM(SSM):
         if (newState == COMPLETED) or (newState == ABORTED):
             self.ssmSAP.clientTransactions.remove(self)
 
+    def get_retry_timeout(self):
+        """Return how long to wait for a confirmation, the device info can
+        override the default."""
+        if self.remoteDevice.retryTimeout is not None:
+            return self.remoteDevice.retryTimeout
+        return self.ssmSAP.retryTimeout
+
+    def get_retry_count(self):
+        """Return how many times to send the request, the device info can
+        override the default."""
+        if self.remoteDevice.retryCount is not None:
+            return self.remoteDevice.retryCount
+        return self.ssmSAP.retryCount
+
     def request(self, apdu):
         """This function is called by client transaction functions when it wants
         to send a message to the device."""
@@ -343,7 +363,7 @@ class ClientSSM(SSM):
             # SendConfirmedUnsegmented
             self.sentAllSegments = True
             self.retryCount = 0
-            self.set_state(AWAIT_CONFIRMATION, self.ssmSAP.retryTimeout)
+            self.set_state(AWAIT_CONFIRMATION, self.get_retry_timeout())
         else:
             # SendConfirmedSegmented
             self.sentAllSegments = False
@@ -432,7 +452,7 @@ class ClientSSM(SSM):
             # final ack received?
             elif self.sentAllSegments:
                 if _debug: ClientSSM._debug("    - all done sending request")
-                self.set_state(AWAIT_CONFIRMATION, self.ssmSAP.retryTimeout)
+                self.set_state(AWAIT_CONFIRMATION, self.get_retry_timeout())
 
             # more segments to send
             else:
@@ -568,8 +588,8 @@ class ClientSSM(SSM):
         if _debug: ClientSSM._debug("await_confirmation_timeout")
 
         self.retryCount += 1
-        if self.retryCount < self.ssmSAP.retryCount:
-            if _debug: ClientSSM._debug("    - no response, try again (%d < %d)", self.retryCount, self.ssmSAP.retryCount)
+        if self.retryCount < self.get_retry_count():
+            if _debug: ClientSSM._debug("    - no response, try again (%d < %d)", self.retryCount, self.get_retry_count())
 
             # save the retry count, indication acts like the request is coming
             # from the application so the retryCount gets re-initialized.
@@ -1049,6 +1069,9 @@ class StateMachineAccessPoint(DeviceInfo, Client, ServiceAccessPoint):
         self.serverTransactions = []
         self.applicationTimeout = device.apduTimeout        # how long the application has to respond
 
+        # device information learned about peers, keyed by address
+        self.deviceInfo = {}
+
     def get_next_invoke_id(self, addr):
         """Called by clients to get an unused invoke ID."""
         if _debug: StateMachineAccessPoint._debug("get_next_invoke_id")
@@ -1073,9 +1096,20 @@ class StateMachineAccessPoint(DeviceInfo, Client, ServiceAccessPoint):
     def get_device_info(self, addr):
         """get the segmentation supported and max APDU length accepted for a device."""
         if _debug: StateMachineAccessPoint._debug("get_device_info %r", addr)
-    
+
+        # return what is known about the device
+        info = self.deviceInfo.get(addr)
+        if info:
+            return info
+
         # return a generic info object
         return DeviceInfo(addr)
+
+    def set_device_info(self, info):
+        """save what is known about a device, replacing the generic info."""
+        if _debug: StateMachineAccessPoint._debug("set_device_info %r", info)
+
+        self.deviceInfo[info.address] = info
     
     def confirmation(self, pdu):
         """Packets coming up the stack are APDU's."""
@@ -5,10 +5,13 @@ Core
 """
 
 import sys
+import errno
+import select
 import asyncore
 import logging
 import signal
 import time
+import threading
 import traceback
 
 from task import TaskManager
@@ -21,6 +24,125 @@ running = False
 taskManager = None
 deferredFns = []
 sleeptime = 0.0
+backend = None
+
+# functions other threads passed to call_soon()
+pendingCalls = []
+pendingLock = threading.Lock()
+
+#
+#   SelectBackend
+#
+
+class SelectBackend:
+
+    """
+    Wait for socket activity with asyncore, which builds the select() sets
+    from the socket map on every call.
+    """
+
+    def poll(self, timeout):
+        # asyncore returns right away when there are no sockets so just
+        # wait for the next task
+        if asyncore.socket_map:
+            asyncore.loop(timeout=timeout, count=1)
+        else:
+            time.sleep(timeout)
+
+    def close(self):
+        pass
+
+#
+#   EPollBackend
+#
+
+class EPollBackend:
+
+    """
+    Wait for socket activity with epoll.  The dispatchers in the socket map
+    stay registered between calls, the kernel is only told about the ones
+    that come or go or change what they are waiting for.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+        # fd -> (dispatcher, event mask) as the kernel knows it
+        self.registered = {}
+
+    def update(self):
+        """Bring the registrations up to date with the socket map."""
+        socket_map = asyncore.socket_map
+        registered = self.registered
+
+        for fd, obj in socket_map.items():
+            # the same events asyncore.poll2() asks for
+            flags = 0
+            if obj.readable():
+                flags |= select.EPOLLIN | select.EPOLLPRI
+            if obj.writable() and not obj.accepting:
+                flags |= select.EPOLLOUT
+
+            entry = registered.get(fd)
+            if entry and (entry[0] is obj) and (entry[1] == flags):
+                continue
+
+            # the fd may have been closed and reused since it was registered
+            if entry and entry[1]:
+                try:
+                    self.epoll.unregister(fd)
+                except (IOError, OSError):
+                    pass
+            if flags:
+                self.epoll.register(fd, flags)
+            registered[fd] = (obj, flags)
+
+        # dispatchers that have gone
+        if len(registered) > len(socket_map):
+            for fd in [fd for fd in registered if fd not in socket_map]:
+                if registered.pop(fd)[1]:
+                    try:
+                        self.epoll.unregister(fd)
+                    except (IOError, OSError):
+                        pass
+
+    def poll(self, timeout):
+        self.update()
+
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, OSError), err:
+            if err.errno != errno.EINTR:
+                raise
+            return
+
+        for fd, flags in events:
+            obj = asyncore.socket_map.get(fd)
+            if obj is not None:
+                asyncore.readwrite(obj, flags)
+
+    def close(self):
+        self.epoll.close()
+        self.registered = {}
+
+#
+#   set_backend
+#
+
+def set_backend(new_backend):
+    """Use a different way of waiting for socket activity, None for the
+    best one the platform has."""
+    _log.debug("set_backend %r", new_backend)
+    global backend
+
+    if backend:
+        backend.close()
+    backend = new_backend
+
+def default_backend():
+    if hasattr(select, 'epoll'):
+        return EPollBackend()
+    return SelectBackend()
 
 #
 #   run
@@ -30,11 +152,15 @@ SPIN = 1.0
 
 def run(spin=SPIN):
     _log.debug("run spin=%r", spin)
-    global running, taskManager, deferredFns, sleeptime
+    global running, taskManager, deferredFns, sleeptime, backend
 
     # reference the task manager (a singleton)
     taskManager = TaskManager()
 
+    # how to wait for socket activity
+    if not backend:
+        backend = default_backend()
+
     # count how many times we are going through the loop
     loopCount = 0
 
@@ -61,13 +187,18 @@ def run(spin=SPIN):
                 time.sleep(sleeptime)
                 delta -= sleeptime
 
-            # if there are deferred functions, use a small delta
-            if deferredFns:
-                delta = min(delta, 0.001)
+            # if there are deferred functions or calls from other threads,
+            # check for socket activity without waiting and get right to them
+            if deferredFns or pendingCalls:
+                delta = 0.0
 #           _log.debug("delta: %r", delta)
 
             # loop for socket activity
-            asyncore.loop(timeout=delta, count=1)
+            backend.poll(delta)
+
+            # calls from other threads
+            if pendingCalls:
+                call_pending()
 
             # check for deferred functions
             while deferredFns:
@@ -118,6 +249,10 @@ def run_once():
             if task:
                 taskManager.process_task(task)
 
+            # calls from other threads
+            if pendingCalls:
+                call_pending()
+
             # check for deferred functions
             while deferredFns:
                 # get a reference to the list
@@ -168,7 +303,7 @@ if hasattr(signal, 'SIGTERM'):
 def print_stack(sig, frame):
     """Signal handler to print a stack trace and some interesting values."""
     _log.debug("print_stack, %r, %r", sig, frame)
-    global running, deferredFns, sleeptime
+    global running, deferredFns, sleeptime, backend, pendingCalls
 
     sys.stderr.write("==== USR1 Signal, %s\n" % time.strftime("%d-%b-%Y %H:%M:%S"))
 
@@ -176,6 +311,8 @@ def print_stack(sig, frame):
     sys.stderr.write("    running: %r\n" % (running,))
     sys.stderr.write("    deferredFns: %r\n" % (deferredFns,))
     sys.stderr.write("    sleeptime: %r\n" % (sleeptime,))
+    sys.stderr.write("    backend: %r\n" % (backend,))
+    sys.stderr.write("    pendingCalls: %r\n" % (pendingCalls,))
 
     sys.stderr.write("---------- stack\n")
     traceback.print_stack(frame)
@@ -211,6 +348,120 @@ def deferred(fn, *args, **kwargs):
     # append it to the list
     deferredFns.append((fn, args, kwargs))
 
+#
+#   call_deferred
+#
+
+def call_deferred():
+    """Call the deferred functions and the ones they defer, for an event
+    loop other than run()."""
+    global deferredFns
+
+    while deferredFns:
+        # get a reference to the list
+        fnlist = deferredFns
+        deferredFns = []
+
+        # call the functions
+        for fn, args, kwargs in fnlist:
+            fn( *args, **kwargs)
+
+#
+#   Future
+#
+
+class Future:
+
+    """
+    The result of a function passed to call_soon(), for the thread that is
+    waiting for it.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the function to be called and return what it returned,
+        or raise what it raised."""
+        if not self._event.wait(timeout):
+            raise RuntimeError, "timeout waiting for the call"
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError, "timeout waiting for the call"
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn(future) when it is done, from the thread running the loop,
+        or right away if it is already done."""
+        with self._lock:
+            if not self._event.isSet():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, err:
+                _log.exception("done callback error: %s", err)
+
+#
+#   call_soon
+#
+
+def call_soon(fn, *args, **kwargs):
+    """Call a function in the thread running the loop, from any thread, and
+    return a Future with its result.  The loop is woken up right away."""
+    future = Future()
+
+    with pendingLock:
+        pendingCalls.append((future, fn, args, kwargs))
+
+    # break out of waiting for socket activity
+    if taskManager and taskManager.trigger:
+        taskManager.trigger.set()
+
+    return future
+
+def call_pending():
+    """Call the functions passed to call_soon() so far."""
+    global pendingCalls
+
+    with pendingLock:
+        calls = pendingCalls
+        pendingCalls = []
+
+    for future, fn, args, kwargs in calls:
+        try:
+            result = fn(*args, **kwargs)
+        except Exception, err:
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+
 #
 #   enable_sleeping
 #
@@ -6,8 +6,12 @@ Task
 
 import sys
 
-from time import time as _time
+from math import ceil as _ceil
+from collections import deque
+from time import time as _time, localtime as _localtime
+from calendar import timegm as _timegm
 from heapq import heapify, heappush, heappop
+from itertools import count as _count
 
 from singleton import SingletonLogging
 from debugging import DebugContents, Logging, function_debugging, ModuleLogger
@@ -20,6 +24,13 @@ _log = ModuleLogger(globals())
 _task_manager = None
 _unscheduled_tasks = []
 
+# cancelled entries are left in the heap until there are at least this many
+# and they are more than half of it, then it is rebuilt without them
+COMPACT_MIN = 64
+
+# resolution and number of slots of the timer wheel, None when it is off
+_timer_wheel = None
+
 # only defined for linux platforms
 if 'linux' in sys.platform:
     from event import WaitableEvent
@@ -47,11 +58,20 @@ if 'linux' in sys.platform:
 class _Task(DebugContents, Logging):
 
     _debug_contents = ('taskTime', 'isScheduled')
-    
+
+    # short lived timers set this to go in the timer wheel when it is on
+    taskWheel = False
+
     def __init__(self):
         self.taskTime = None
         self.isScheduled = False
 
+        # the heap entry that is live for this task
+        self.taskEntry = None
+
+        # the wheel tick when it is in the timer wheel
+        self.taskTick = None
+
     def install_task(self, when=None):
         global _task_manager, _unscheduled_tasks
 
@@ -168,6 +188,55 @@ class RecurringTask(_Task):
         else:
             _task_manager.install_task(self)
         
+#
+#   ClockAlignedTask
+#
+
+class ClockAlignedTask(RecurringTask):
+
+    """
+    A recurring task that runs on the boundaries of its interval in local
+    time, like on the hour or every quarter hour, plus an optional offset.
+    The taskTime is the boundary, so process_task can use it as the time
+    the task was meant to run.
+    """
+
+    _debug_contents = ('taskOffset',)
+
+    def __init__(self, interval=None, offset=0):
+        RecurringTask.__init__(self, interval)
+        self.taskOffset = offset
+        if interval is not None:
+            self.taskTime = self.next_boundary(_time())
+
+    def next_boundary(self, now):
+        """Return the first boundary after now."""
+        interval = self.taskInterval / 1000.0
+
+        # seconds east of UTC right now, follows daylight saving time
+        utc_offset = _timegm(_localtime(now)) - int(now)
+
+        local = now + utc_offset - (self.taskOffset / 1000.0)
+        return now + interval - (local % interval)
+
+    def install_task(self, interval=None):
+        global _task_manager, _unscheduled_tasks
+
+        # set the interval if it hasn't already been set
+        if interval is not None:
+            self.taskInterval = interval
+        if not self.taskInterval:
+            raise RuntimeError, "interval unset, use ctor or install_task parameter"
+
+        # get ready for the next boundary
+        self.taskTime = self.next_boundary(_time())
+
+        # pass along to the task manager
+        if not _task_manager:
+            _unscheduled_tasks.append(self)
+        else:
+            _task_manager.install_task(self)
+
 #
 #   RecurringFunctionTask
 #
@@ -209,6 +278,135 @@ def recurring_function(interval):
 
     return recurring_function_decorator
 
+#
+#   TimerWheel
+#
+
+class TimerWheel(Logging):
+
+    """
+    A hashed timer wheel for the many short timeouts of transactions that are
+    installed and cancelled over and over.  Each slot is a tick of the
+    resolution and a set of tasks, a task due more than a turn of the wheel
+    away waits in its slot until its tick comes around, so installing and
+    cancelling are O(1).  Tasks fire on the first tick at or after their
+    time, never early.
+    """
+
+    def __init__(self, resolution=1, slots=4096):
+        if _debug: TimerWheel._debug("__init__ %r %r", resolution, slots)
+
+        # tick length in seconds, resolution is in milliseconds
+        self.resolution = resolution / 1000.0
+        self.slots = [set() for i in xrange(slots)]
+
+        # the last tick that has been looked at
+        self.current = int(_time() / self.resolution)
+
+        # tasks in the slots, (entry, task) items that are due
+        self.count = 0
+        self.ready = deque()
+
+        # the tick of the next task, None when it has to be looked for
+        self.wakeup = None
+
+    def install(self, task):
+        """Add a task, return True if it is the next one due."""
+        tick = max(int(_ceil(task.taskTime / self.resolution)), self.current + 1)
+        task.taskTick = tick
+        self.slots[tick % len(self.slots)].add(task)
+
+        self.count += 1
+        if (self.count == 1) or ((self.wakeup is not None) and (tick < self.wakeup)):
+            self.wakeup = tick
+            return True
+        return False
+
+    def cancel(self, task):
+        """Take a task out of its slot, one that is already in the ready
+        queue is skipped because its entry is no longer live."""
+        slot = self.slots[task.taskTick % len(self.slots)]
+        if task in slot:
+            slot.remove(task)
+            self.count -= 1
+        task.taskTick = None
+
+    def advance(self, now):
+        """Move the tasks due by now to the ready queue in time order."""
+        tick = int(now / self.resolution)
+        if tick <= self.current:
+            return
+
+        if self.count:
+            slots = self.slots
+            if tick - self.current >= len(slots):
+                # a whole turn or more has gone by
+                visit = slots
+            else:
+                visit = [slots[i % len(slots)] for i in xrange(self.current + 1, tick + 1)]
+
+            due = []
+            for slot in visit:
+                if slot:
+                    for task in [task for task in slot if task.taskTick <= tick]:
+                        slot.remove(task)
+                        due.append(task)
+
+            due.sort(key=lambda task: task.taskTime)
+            for task in due:
+                self.ready.append((task.taskEntry, task))
+            self.count -= len(due)
+
+        self.current = tick
+        if (self.wakeup is not None) and (self.wakeup <= tick):
+            self.wakeup = None
+
+    def next_ready(self):
+        """Return the next due task that has not been cancelled, or None."""
+        while self.ready:
+            entry, task = self.ready.popleft()
+            if task.taskEntry == entry:
+                task.taskTick = None
+                return task
+        return None
+
+    def next_time(self):
+        """Return the time of the next tick with a task, or None."""
+        if not self.count:
+            return None
+
+        if self.wakeup is None:
+            slots = self.slots
+            for i in xrange(1, len(slots) + 1):
+                tick = self.current + i
+                slot = slots[tick % len(slots)]
+                if slot:
+                    first = min(task.taskTick for task in slot)
+
+                    # nothing earlier can be in a slot further along
+                    if first == tick:
+                        self.wakeup = tick
+                        break
+                    if (self.wakeup is None) or (first < self.wakeup):
+                        self.wakeup = first
+
+        return self.wakeup * self.resolution
+
+#
+#   enable_timer_wheel
+#
+
+def enable_timer_wheel(resolution=1, slots=4096):
+    """Put the tasks that have taskWheel set, like the transaction timers,
+    in a timer wheel with a resolution in milliseconds rather than in the
+    heap with the other tasks."""
+    _log.debug("enable_timer_wheel %r %r", resolution, slots)
+    global _timer_wheel
+
+    _timer_wheel = (resolution, slots)
+    if _task_manager and not _task_manager.wheel:
+        _task_manager.wheel = TimerWheel(resolution, slots)
+
 #
 #   TaskManager
 #
@@ -219,8 +417,17 @@ class TaskManager(SingletonLogging):
         if _debug: TaskManager._debug("__init__")
         global _task_manager, _unscheduled_tasks
 
-        # initialize
+        # initialize, the heap has (when, entry, task) items and the ones
+        # that are no longer the live entry of their task are cancelled
         self.tasks = []
+        self.entries = _count()
+        self.cancelled = 0
+        self.compactions = 0
+
+        # short lived timers, when it is enabled
+        self.wheel = None
+        if _timer_wheel:
+            self.wheel = TimerWheel(*_timer_wheel)
         if 'linux' in sys.platform:
             self.trigger = _Trigger()
         else:
@@ -242,41 +449,81 @@ class TaskManager(SingletonLogging):
         if task.isScheduled:
             self.suspend_task(task)
 
-        # save this in the task list
-        heappush( self.tasks, (task.taskTime, task) )
-        if _debug: TaskManager._debug("    - tasks: %r", self.tasks)
-
+        entry = self.entries.next()
+        task.taskEntry = entry
         task.isScheduled = True
 
-        # trigger the event
-        if self.trigger:
+        if self.wheel and task.taskWheel:
+            sooner = self.wheel.install(task)
+        else:
+            # save this in the task list, the entry number keeps tasks due
+            # at the same time in the order they were installed
+            heappush( self.tasks, (task.taskTime, entry, task) )
+            if _debug: TaskManager._debug("    - tasks: %r", self.tasks)
+            sooner = (self.tasks[0][1] == entry)
+
+        # trigger the event when the loop has to wake up sooner
+        if self.trigger and sooner:
             self.trigger.set()
 
     def suspend_task(self, task):
         if _debug: TaskManager._debug("suspend_task %r", task)
 
-        # remove this guy
-        for i, (when, curtask) in enumerate(self.tasks):
-            if task is curtask:
-                if _debug: TaskManager._debug("    - task found")
-                del self.tasks[i]
+        if not task.isScheduled:
+            if _debug: TaskManager._debug("    - task not scheduled")
+            return
 
-                task.isScheduled = False
-                heapify(self.tasks)
-                break
-        else:
-            if _debug: TaskManager._debug("    - task not found")
+        task.taskEntry = None
+        task.isScheduled = False
+
+        # out of the timer wheel right away
+        if task.taskTick is not None:
+            self.wheel.cancel(task)
+            return
+
+        # leave the entry in the heap, it is skipped when it comes up
+        self.cancelled += 1
+
+        # rebuild the heap when it is mostly cancelled entries, an early
+        # wakeup for a cancelled task is harmless so there is no trigger
+        if (self.cancelled >= COMPACT_MIN) and (self.cancelled * 2 > len(self.tasks)):
+            self.compact()
 
-        # trigger the event
-        if self.trigger:
-            self.trigger.set()
-        
     def resume_task(self, task):
         if _debug: TaskManager._debug("resume_task %r", task)
             
         # just re-install it
         self.install_task(task)
 
+    def compact(self):
+        """Rebuild the heap without the cancelled entries."""
+        if _debug: TaskManager._debug("compact %r %r", len(self.tasks), self.cancelled)
+
+        self.tasks = [item for item in self.tasks if item[2].taskEntry == item[1]]
+        heapify(self.tasks)
+        self.cancelled = 0
+        self.compactions += 1
+
+    def _discard_cancelled(self):
+        """Pop the cancelled entries off the top of the heap."""
+        tasks = self.tasks
+        while tasks and (tasks[0][2].taskEntry != tasks[0][1]):
+            heappop(tasks)
+            self.cancelled -= 1
+
+    def statistics(self):
+        """Return a dict of the heap size, the number of scheduled tasks and
+        how much of the heap is cancelled entries."""
+        size = len(self.tasks)
+        return {
+            'heap_size': size,
+            'scheduled': size - self.cancelled,
+            'cancelled': self.cancelled,
+            'cancelled_ratio': (float(self.cancelled) / size) if size else 0.0,
+            'compactions': self.compactions,
+            'wheel_timers': self.wheel.count if self.wheel else 0,
+            }
+
     def get_next_task(self):
         """get the next task if there's one that should be processed, 
         and return how long it will be until the next one should be 
@@ -289,22 +536,42 @@ class TaskManager(SingletonLogging):
         task = None
         delta = None
 
+        # timers from the wheel that are due go first
+        if self.wheel:
+            self.wheel.advance(now)
+            task = self.wheel.next_ready()
+            if task:
+                task.taskEntry = None
+                task.isScheduled = False
+                return (task, 0.0)
+
+        self._discard_cancelled()
         if self.tasks:
             # look at the first task
-            when, nxttask = self.tasks[0]
+            when, entry, nxttask = self.tasks[0]
             if when <= now:
                 # pull it off the list and mark that it's no longer scheduled
                 heappop(self.tasks)
                 task = nxttask
+                task.taskEntry = None
                 task.isScheduled = False
 
+                self._discard_cancelled()
                 if self.tasks:
-                    when, nxttask = self.tasks[0]
+                    when, entry, nxttask = self.tasks[0]
                     # peek at the next task, return how long to wait
                     delta = max(when - now, 0.0)
             else:
                 delta = when - now
 
+        # the wheel may have a timer due sooner
+        if self.wheel:
+            when = self.wheel.next_time()
+            if when is not None:
+                wheel_delta = max(when - now, 0.0)
+                if (delta is None) or (wheel_delta < delta):
+                    delta = wheel_delta
+
         # return the task to run and how long to wait for the next one
         return (task, delta)
 
@@ -44,6 +44,7 @@ class UDPActor(Logging):
         self.timeout = director.timeout
         if self.timeout > 0:
             self.timer = FunctionTask(self.IdleTimeout)
+            self.timer.taskWheel = True
             self.timer.install_task(_time() + self.timeout)
         else:
             self.timer = None
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+"""
+Billing
+
+Print the consumption and invoice of every meter, or of every grs or busbar
+group, between two days as CSV.
+"""
+
+import csv
+import sys
+import json
+
+from bacpypes.debugging import ModuleLogger
+from bacpypes.consolelogging import ArgumentParser
+
+import meterdb
+import meterdefs
+import meterbilling
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# columns of each kind of report
+COLUMNS = {
+    'meter': ['id', 'opening', 'closing', 'consumption', 'invoice', 'complete'],
+    'grs': ['grs', 'meters', 'consumption', 'invoice'],
+    'busbar': ['grs', 'busbar', 'meters', 'consumption', 'invoice'],
+    }
+
+#
+#   __main__
+#
+
+try:
+    # parse the command line arguments
+    parser = ArgumentParser(description=__doc__)
+
+    parser.add_argument('start',
+        help="first day, YYYY-MM-DD",
+        )
+    parser.add_argument('end',
+        help="last day, YYYY-MM-DD",
+        )
+    parser.add_argument('--group',
+        help="total by meter, grs or busbar",
+        choices=['meter', 'grs', 'busbar'],
+        default='meter',
+        )
+    parser.add_argument('--unitprice', type=float,
+        help="price of a kWh, the one saved by the web page by default",
+        )
+    parser.add_argument('--db',
+        help="database file",
+        default=meterdb.SQLITE_FILE,
+        )
+    parser.add_argument('--definitions',
+        help="meter definitions spreadsheet, needed for the groups",
+        default='C:/MeterDefinitions.xls',
+        )
+
+    # now parse the arguments
+    args = parser.parse_args()
+
+    if _debug: _log.debug("initialization")
+    if _debug: _log.debug("    - args: %r", args)
+
+    unitprice = args.unitprice
+    if unitprice is None:
+        unitprice = float(json.load(open('media/data.json'))['unitprice'])
+
+    dict_mako = None
+    if args.group != 'meter':
+        point_list, dict_mako = meterdefs.load_definitions(args.definitions)
+
+    conn = meterdb.connect(args.db)
+    try:
+        report = meterbilling.billing_report(conn, args.start, args.end, unitprice, dict_mako, args.group)
+    finally:
+        conn.close()
+
+    writer = csv.writer(sys.stdout)
+    columns = COLUMNS[args.group]
+    writer.writerow(columns)
+    for row in report:
+        writer.writerow([unicode(row[column]).encode('utf-8') for column in columns])
+
+except Exception, e:
+    _log.exception("an error has occurred: %s", e)
+finally:
+    _log.debug("finally")
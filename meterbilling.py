@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+"""
+Meter Billing
+
+Compute the consumption of every meter for a period from the daily rollup in
+one query and one pass over the rows, then total it by grs and busbar group.
+
+The opening reading is the last good reading of the first day and the closing
+reading is the last good reading of the last day.  The single meter submit
+page uses the largest reading of each day instead, which is not the same on
+a day the counter was reset.  In between, every increase of the counter is
+added up, days without good readings are bridged by the next reading, and a
+reading lower than the one before it is taken as a counter reset, counting
+from zero.
+"""
+
+from bacpypes.debugging import ModuleLogger, function_debugging
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+#
+#   counter_delta
+#
+
+def counter_delta(previous, current):
+    """Return the consumption between two counter readings."""
+    if current >= previous:
+        return current - previous
+    else:
+        # the counter was reset and started over from zero
+        return current
+
+#
+#   MeterBill
+#
+
+class MeterBill(object):
+
+    __slots__ = ('meter_id', 'first_day', 'last_day', 'opening', 'closing', 'consumption')
+
+    def __init__(self, meter_id, day, opening):
+        self.meter_id = meter_id
+        self.first_day = self.last_day = day
+        self.opening = self.closing = opening
+        self.consumption = 0.0
+
+    def is_complete(self, start_day, end_day):
+        """True when there are good readings on the first and last days."""
+        return (self.first_day == start_day) and (self.last_day == end_day)
+
+    def dict_contents(self, start_day, end_day, unitprice):
+        return {
+            'opening': self.opening,
+            'closing': self.closing,
+            'consumption': self.consumption,
+            'invoice': self.consumption / 1000.0 * unitprice,
+            'complete': self.is_complete(start_day, end_day),
+            }
+
+#
+#   compute_bills
+#
+
+@function_debugging
+def compute_bills(conn, start_day, end_day):
+    """Return a dict of MeterBill by meter id for the days from start_day
+    to end_day inclusive, both 'YYYY-MM-DD'."""
+    if _debug: compute_bills._debug("compute_bills %r %r", start_day, end_day)
+
+    rows = conn.execute('''SELECT id, day, first_value, last_value, max_value
+        FROM tenant_counter_daily WHERE day >= ? AND day <= ?
+        ORDER BY id, day''',
+        (start_day, end_day),
+        )
+
+    bills = {}
+    bill = None
+    for meter_id, day, first_value, last_value, max_value in rows:
+        if (bill is None) or (bill.meter_id != meter_id):
+            if day == start_day:
+                # start from the end of the first day
+                bill = bills[meter_id] = MeterBill(meter_id, day, last_value)
+                continue
+
+            # no readings on the first day, start with the earliest one
+            bill = bills[meter_id] = MeterBill(meter_id, day, first_value)
+        else:
+            # across the gap since the last day with readings
+            bill.consumption += counter_delta(bill.closing, first_value)
+
+        # within the day, a reset shows up as the last reading below the first
+        if last_value >= first_value:
+            bill.consumption += last_value - first_value
+        else:
+            bill.consumption += (max_value - first_value) + last_value
+
+        bill.last_day = day
+        bill.closing = last_value
+
+    return bills
+
+#
+#   group_bills
+#
+
+def group_bills(bills, dict_mako, group):
+    """Return the consumption totals of the meters in each group, keyed by
+    grs for 'grs' and by (grs, busbar) for 'busbar'."""
+    totals = {}
+    for grs_key, busbars in dict_mako.iteritems():
+        for busbar_key, program_ids in busbars.iteritems():
+            if group == 'grs':
+                key = grs_key
+            elif group == 'busbar':
+                key = (grs_key, busbar_key)
+            else:
+                raise ValueError, "unknown group: %r" % (group,)
+
+            total = totals.setdefault(key, [0.0, 0])
+            for program_id in program_ids:
+                bill = bills.get(program_id)
+                if bill:
+                    total[0] += bill.consumption
+                    total[1] += 1
+
+    return totals
+
+#
+#   billing_report
+#
+
+@function_debugging
+def billing_report(conn, start_day, end_day, unitprice, dict_mako=None, group='meter'):
+    """Return a list of dicts, one for each meter or group, sorted by name."""
+    if _debug: billing_report._debug("billing_report %r %r %r %r", start_day, end_day, unitprice, group)
+
+    bills = compute_bills(conn, start_day, end_day)
+
+    report = []
+    if group == 'meter':
+        for meter_id in sorted(bills):
+            row = bills[meter_id].dict_contents(start_day, end_day, unitprice)
+            row['id'] = meter_id
+            report.append(row)
+    else:
+        totals = group_bills(bills, dict_mako, group)
+        for key in sorted(totals):
+            consumption, meters = totals[key]
+            row = {'consumption': consumption,
+                'invoice': consumption / 1000.0 * unitprice,
+                'meters': meters,
+                }
+            if group == 'grs':
+                row['grs'] = key
+            else:
+                row['grs'], row['busbar'] = key
+            report.append(row)
+
+    return report
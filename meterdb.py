@@ -0,0 +1,635 @@
+#!/usr/bin/python
+
+"""
+Meter Database
+
+The recorder keeps one connection to tenantdata.sqlite open in WAL mode so
+the hourly save does not block the web readers, and writes a whole snapshot
+of readings in a single transaction.
+
+Readings are stored with the time as integer seconds since the epoch, the
+value as a real, and the quality from meterreadings in its own column so
+lookups by meter and time use the (id, date_time) index.  Databases with the
+original text schema are converted by migrate() in chunks.
+
+A trigger keeps the first, last and largest good reading of each meter for
+each day in tenant_counter_daily as the rows go in, billing reads that
+rather than the raw rows, so the raw rows can be pruned by age.
+
+The raw rows are kept in a table for each month, like tenant_counter_202001,
+each with its own index and trigger.  Queries only read the months that
+overlap the range they want, and old months are pruned by dropping their
+tables, so neither gets slower as the years go by.
+"""
+
+import re
+import time
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger, function_debugging
+
+import meterreadings
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# database file and table
+SQLITE_FILE = 'tenantdata.sqlite'
+TABLE_NAME = 'tenant_counter'
+
+# value the original schema saved when there was no good reading
+ERROR_VALUE = 'Error!'
+
+# entries kept by the daily reading cache, each is a key and a small tuple
+# of about 300 bytes so this is about 15MB
+DAILY_CACHE_SIZE = 50000
+
+# PRAGMA user_version of the current schema
+SCHEMA_VERSION = 4
+
+# raw readings, one table for each month
+PARTITION_TABLE = '''CREATE TABLE IF NOT EXISTS %(table)s (
+    id TEXT NOT NULL,
+    date_time INTEGER NOT NULL,
+    value REAL,
+    quality INTEGER NOT NULL
+    )'''
+
+PARTITION_INDEX = '''CREATE INDEX IF NOT EXISTS %(table)s_id_date_time
+    ON %(table)s (id, date_time)'''
+
+# names of the monthly tables
+PARTITION_PATTERN = re.compile(r'^%s_(\d{6})$' % (TABLE_NAME,))
+
+# the single table of the earlier schemas, a migration copies into it
+TABLE_SCHEMA = PARTITION_TABLE % {'table': TABLE_NAME}
+INDEX_SCHEMA = PARTITION_INDEX % {'table': TABLE_NAME}
+
+# daily rollup of the good readings, the day is local 'YYYY-MM-DD'
+DAILY_SCHEMA = '''CREATE TABLE IF NOT EXISTS tenant_counter_daily (
+    id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    first_time INTEGER NOT NULL,
+    first_value REAL,
+    last_time INTEGER NOT NULL,
+    last_value REAL,
+    max_value REAL,
+    PRIMARY KEY (id, day)
+    )'''
+
+# no upsert in the older sqlite builds, so insert the day if it is new and
+# then fold the reading into it, rows that arrive out of order are fine
+PARTITION_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS %(table)s_rollup
+    AFTER INSERT ON %(table)s
+    WHEN NEW.quality = 0
+    BEGIN
+        INSERT OR IGNORE INTO tenant_counter_daily VALUES (
+            NEW.id, date(NEW.date_time, 'unixepoch', 'localtime'),
+            NEW.date_time, NEW.value, NEW.date_time, NEW.value, NEW.value
+            );
+        UPDATE tenant_counter_daily SET
+            first_value = CASE WHEN NEW.date_time < first_time THEN NEW.value ELSE first_value END,
+            first_time = min(first_time, NEW.date_time),
+            last_value = CASE WHEN NEW.date_time >= last_time THEN NEW.value ELSE last_value END,
+            last_time = max(last_time, NEW.date_time),
+            max_value = max(max_value, NEW.value)
+        WHERE id = NEW.id AND day = date(NEW.date_time, 'unixepoch', 'localtime');
+    END'''
+
+# sequence number of the last journal record saved, updated in the same
+# transaction as the rows so a record is never saved twice
+CHECKPOINT_SCHEMA = '''CREATE TABLE IF NOT EXISTS tenant_counter_checkpoint (
+    name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+    )'''
+
+SCHEMA = [DAILY_SCHEMA, CHECKPOINT_SCHEMA]
+
+#
+#   SchemaError
+#
+
+class SchemaError(RuntimeError):
+    """The database needs to be migrated."""
+
+#
+#   connect
+#
+
+def connect(path=SQLITE_FILE):
+    """Return a connection in WAL mode that can be shared between threads."""
+    conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+#
+#   epoch
+#
+
+def epoch(dt):
+    """Return a local datetime as integer seconds since the epoch."""
+    return int(time.mktime(dt.timetuple()))
+
+#
+#   day_range
+#
+
+def day_range(date_str):
+    """Return the start and end (exclusive) epoch seconds of a 'YYYY-MM-DD'."""
+    year, month, day = [int(part) for part in date_str.split('-')]
+    start = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+    end = int(time.mktime((year, month, day + 1, 0, 0, 0, 0, 0, -1)))
+    return start, end
+
+#
+#   month_range
+#
+
+def month_range(when):
+    """Return the start and end (exclusive) epoch seconds of the local month
+    of an epoch time."""
+    year, month = time.localtime(when)[:2]
+    start = int(time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1)))
+    end = int(time.mktime((year, month + 1, 1, 0, 0, 0, 0, 0, -1)))
+    return start, end
+
+#
+#   partition_name
+#
+
+def partition_name(when):
+    """Return the name of the table for an epoch time."""
+    return '%s_%s' % (TABLE_NAME, time.strftime('%Y%m', time.localtime(when)))
+
+#
+#   ensure_partition
+#
+
+def ensure_partition(conn, table):
+    """Create a monthly table with its index and trigger."""
+    for template in (PARTITION_TABLE, PARTITION_INDEX, PARTITION_TRIGGER):
+        conn.execute(template % {'table': table})
+
+#
+#   partitions
+#
+
+def partitions(conn):
+    """Return the names of the monthly tables, oldest first."""
+    names = [row[0] for row in conn.execute('''SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name LIKE ?''', (TABLE_NAME + '_%',))]
+    return sorted(name for name in names if PARTITION_PATTERN.match(name))
+
+def partitions_between(conn, start, end):
+    """Return the names of the monthly tables that overlap the epoch times
+    from start up to but not including end, oldest first."""
+    existing = set(partitions(conn))
+
+    names = []
+    month_start = month_range(start)[0]
+    while month_start < end:
+        name = partition_name(month_start)
+        if name in existing:
+            names.append(name)
+        month_start = month_range(month_start)[1]
+
+    return names
+
+#
+#   split_table
+#
+
+def split_table(conn, table):
+    """Move the rows of a single table into monthly tables and drop it.  The
+    table statements commit on their own, so each month is copied and
+    deleted from the table together, and a split that was interrupted picks
+    up with the months that are left."""
+    first, last = conn.execute('SELECT min(date_time), max(date_time) FROM %s' % (table,)).fetchone()
+
+    if first is not None:
+        month_start = month_range(first)[0]
+        while month_start <= last:
+            month_end = month_range(month_start)[1]
+            name = partition_name(month_start)
+
+            # the trigger goes on after the copy, the rollup has these rows
+            conn.execute(PARTITION_TABLE % {'table': name})
+            with conn:
+                conn.execute('''INSERT INTO %s SELECT * FROM %s
+                    WHERE date_time >= ? AND date_time < ?''' % (name, table),
+                    (month_start, month_end),
+                    )
+                conn.execute('''DELETE FROM %s
+                    WHERE date_time >= ? AND date_time < ?''' % (table,),
+                    (month_start, month_end),
+                    )
+            ensure_partition(conn, name)
+
+            month_start = month_end
+
+    # including the months moved before an interruption
+    for name in partitions(conn):
+        ensure_partition(conn, name)
+
+    conn.execute('DROP TABLE %s' % (table,))
+
+#
+#   table_columns
+#
+
+def table_columns(conn, table):
+    """Return the column names of a table, an empty list if it is missing."""
+    return [row[1] for row in conn.execute('PRAGMA table_info(%s)' % (table,))]
+
+#
+#   ensure_schema
+#
+
+def ensure_schema(conn):
+    """Create the tables if they are missing, raise SchemaError if the
+    database still has the original schema."""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version == SCHEMA_VERSION:
+        return
+
+    columns = table_columns(conn, TABLE_NAME)
+    if columns and ('sayacdeger' in columns):
+        raise SchemaError, "%s needs to be migrated, run migrate_tenantdata.py" % (TABLE_NAME,)
+    if table_columns(conn, TABLE_NAME + '_legacy'):
+        raise SchemaError, "%s migration is not finished, run migrate_tenantdata.py" % (TABLE_NAME,)
+
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+        # the single table of the earlier schemas
+        if table_columns(conn, TABLE_NAME):
+            # the rows saved before there was a rollup
+            if version == 1:
+                build_daily(conn, TABLE_NAME)
+            split_table(conn, TABLE_NAME)
+
+        conn.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION,))
+
+#
+#   build_daily
+#
+
+def build_daily(conn, table):
+    """Fill in the daily rollup from the raw rows of a table that was not
+    kept up to date by a trigger."""
+    conn.execute('''INSERT OR REPLACE INTO tenant_counter_daily (id, day, first_time, last_time, max_value)
+        SELECT id, date(date_time, 'unixepoch', 'localtime') AS day,
+            min(date_time), max(date_time), max(value)
+        FROM %s WHERE quality = ? GROUP BY id, day''' % (table,),
+        (meterreadings.GOOD,),
+        )
+    conn.execute('''UPDATE tenant_counter_daily SET
+        first_value = (SELECT value FROM %(table)s AS r
+            WHERE r.id = tenant_counter_daily.id AND r.date_time = tenant_counter_daily.first_time
+            AND r.quality = ? LIMIT 1),
+        last_value = (SELECT value FROM %(table)s AS r
+            WHERE r.id = tenant_counter_daily.id AND r.date_time = tenant_counter_daily.last_time
+            AND r.quality = ? LIMIT 1)
+        WHERE EXISTS (SELECT 1 FROM %(table)s AS r
+            WHERE r.id = tenant_counter_daily.id AND r.date_time = tenant_counter_daily.first_time)''' % {'table': table},
+        (meterreadings.GOOD, meterreadings.GOOD),
+        )
+
+#
+#   daily_reading
+#
+
+def daily_reading(conn, meter_id, date_str):
+    """Return the first, last and largest good readings of a meter on a day,
+    None if there are none."""
+    return conn.execute('''SELECT first_value, last_value, max_value
+        FROM tenant_counter_daily WHERE id = ? AND day = ?''',
+        (meter_id, date_str),
+        ).fetchone()
+
+#
+#   max_reading
+#
+
+def max_reading(conn, meter_id, date_str):
+    """Return the largest good reading of a meter on a day, None if there
+    are none."""
+    row = daily_reading(conn, meter_id, date_str)
+    if row is None:
+        return None
+    return row[2]
+
+#
+#   checkpoint
+#
+
+def checkpoint(conn, name='journal'):
+    """Return the sequence number of the last journal record saved, or the
+    epoch time of the last save for 'saved_time', zero if there is not one."""
+    row = conn.execute('''SELECT seq FROM tenant_counter_checkpoint WHERE name = ?''',
+        (name,),
+        ).fetchone()
+    return row[0] if row else 0
+
+#
+#   prune
+#
+
+@function_debugging
+def prune(conn, before):
+    """Drop the monthly tables that end before a datetime, the month it is
+    in is kept whole.  The daily rollup is kept.  Returns the names of the
+    tables dropped."""
+    if _debug: prune._debug("prune %r", before)
+
+    cutoff = epoch(before)
+    dropped = []
+    for name in partitions(conn):
+        month_start = int(time.mktime(time.strptime(PARTITION_PATTERN.match(name).group(1), '%Y%m')))
+        if month_range(month_start)[1] > cutoff:
+            break
+
+        with conn:
+            conn.execute('DROP TABLE %s' % (name,))
+        dropped.append(name)
+
+    return dropped
+
+#
+#   migrate
+#
+
+def _legacy_row(row):
+    """Convert a row of the original schema, return None if it is unusable."""
+    rowid, meter_id, date_time, sayacdeger = row
+    try:
+        date_part, time_part = date_time.split(' ')
+        year, month, day = [int(part) for part in date_part.split('-')]
+        hour, minute, second = [int(part) for part in time_part.split(':')]
+    except (AttributeError, ValueError):
+        return None
+    when = int(time.mktime((year, month, day, hour, minute, second, 0, 0, -1)))
+
+    if isinstance(sayacdeger, (int, long, float)):
+        return (meter_id, when, float(sayacdeger), meterreadings.GOOD)
+    else:
+        return (meter_id, when, None, meterreadings.ERROR)
+
+@function_debugging
+def migrate(conn, chunk_size=50000, progress=None):
+    """Convert a database with the original text schema in place, copying
+    chunk_size rows per transaction.  An interrupted migration continues
+    where it left off.  Returns the number of rows copied and skipped."""
+    if _debug: migrate._debug("migrate %r %r", conn, chunk_size)
+    legacy = TABLE_NAME + '_legacy'
+
+    columns = table_columns(conn, TABLE_NAME)
+    if columns and ('sayacdeger' in columns):
+        # set the old table aside, the rename commits on its own
+        with conn:
+            conn.execute('ALTER TABLE %s RENAME TO %s' % (TABLE_NAME, legacy))
+    elif not table_columns(conn, legacy):
+        # nothing to convert
+        ensure_schema(conn)
+        return 0, 0
+
+    # start the new table and the bookmark, each step can be repeated so a
+    # run that was interrupted after the rename picks up from here, the
+    # index is built at the end because that is faster than keeping it up
+    # to date
+    with conn:
+        conn.execute(TABLE_SCHEMA)
+        conn.execute('CREATE TABLE IF NOT EXISTS %s_migration (last_rowid INTEGER)' % (TABLE_NAME,))
+        if conn.execute('SELECT count(*) FROM %s_migration' % (TABLE_NAME,)).fetchone()[0] == 0:
+            conn.execute('INSERT INTO %s_migration VALUES (0)' % (TABLE_NAME,))
+
+    last_rowid = conn.execute('SELECT last_rowid FROM %s_migration' % (TABLE_NAME,)).fetchone()[0]
+    total = conn.execute('SELECT count(*) FROM %s WHERE rowid > ?' % (legacy,), (last_rowid,)).fetchone()[0]
+
+    copied = skipped = 0
+    while True:
+        rows = conn.execute('''SELECT rowid, id, date_time, sayacdeger FROM %s
+            WHERE rowid > ? ORDER BY rowid LIMIT ?''' % (legacy,),
+            (last_rowid, chunk_size),
+            ).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+
+        new_rows = []
+        for row in rows:
+            new_row = _legacy_row(row)
+            if new_row:
+                new_rows.append(new_row)
+            else:
+                skipped += 1
+
+        # the copy and the bookmark go together
+        with conn:
+            conn.executemany('INSERT INTO %s VALUES (?,?,?,?)' % (TABLE_NAME,), new_rows)
+            conn.execute('UPDATE %s_migration SET last_rowid = ?' % (TABLE_NAME,), (last_rowid,))
+        copied += len(new_rows)
+
+        if progress:
+            progress(copied + skipped, total)
+
+    # finish up, the rows go into the rollup and the monthly tables
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.execute(INDEX_SCHEMA)
+        build_daily(conn, TABLE_NAME)
+        split_table(conn, TABLE_NAME)
+        conn.execute('DROP TABLE %s' % (legacy,))
+        conn.execute('DROP TABLE %s_migration' % (TABLE_NAME,))
+        conn.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION,))
+
+    return copied, skipped
+
+#
+#   Recorder
+#
+
+@bacpypes_debugging
+class Recorder(object):
+
+    def __init__(self, path=SQLITE_FILE):
+        if _debug: Recorder._debug("__init__ %r", path)
+
+        self.path = path
+        self.conn = None
+
+        # the timer threads take turns with the connection
+        self.lock = threading.Lock()
+
+        # monthly tables known to exist
+        self.partitions = set()
+
+    def get_connection(self):
+        if not self.conn:
+            conn = connect(self.path)
+            try:
+                ensure_schema(conn)
+            except:
+                conn.close()
+                raise
+            self.conn = conn
+        return self.conn
+
+    def close(self):
+        if _debug: Recorder._debug("close")
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def prune(self, before):
+        """Drop the months of raw rows that end before a datetime."""
+        if _debug: Recorder._debug("prune %r", before)
+
+        with self.lock:
+            conn = self.get_connection()
+            try:
+                self.partitions.clear()
+                return prune(conn, before)
+            except sqlite3.Error:
+                conn.close()
+                self.conn = None
+                raise
+
+    def checkpoint(self):
+        """Return the sequence number of the last journal record saved."""
+        with self.lock:
+            return checkpoint(self.get_connection())
+
+    def save(self, readings, save_time, seq=None):
+        """Save a snapshot of readings, a dict of Reading by program id, all
+        stamped with the same save time.  The sequence number of the journal
+        record is saved with them, a record that is already saved is skipped.
+        Returns the number of rows saved."""
+        if _debug: Recorder._debug("save %r %r", save_time, seq)
+
+        # convert the time once for the whole snapshot
+        date_time = epoch(save_time)
+
+        rows = [(program_id, date_time, reading.value, reading.quality)
+            for program_id, reading in readings.iteritems()
+            ]
+
+        table = partition_name(date_time)
+
+        with self.lock:
+            conn = self.get_connection()
+            try:
+                with conn:
+                    # saved before, the caller is retrying
+                    if (seq is not None) and (checkpoint(conn) >= seq):
+                        if _debug: Recorder._debug("    - already saved")
+                        return 0
+
+                    if table not in self.partitions:
+                        ensure_partition(conn, table)
+                    conn.executemany('INSERT INTO %s VALUES (?,?,?,?)' % (table,), rows)
+
+                    # the records are saved in order, so the days before this
+                    # one have all their rows
+                    conn.execute('''INSERT OR REPLACE INTO tenant_counter_checkpoint
+                        VALUES ('saved_time', ?)''', (date_time,))
+                    if seq is not None:
+                        conn.execute('''INSERT OR REPLACE INTO tenant_counter_checkpoint
+                            VALUES ('journal', ?)''', (seq,))
+                self.partitions.add(table)
+            except sqlite3.Error:
+                # start over with a fresh connection next time
+                conn.close()
+                self.conn = None
+                raise
+
+        return len(rows)
+
+#
+#   DailyCache
+#
+
+@bacpypes_debugging
+class DailyCache(object):
+
+    """
+    Least recently used cache of the daily rollup rows by meter and day.
+    The rows of days before the day of the last save never change, because
+    the saves go in in order.  The rest, which may still be waiting in the
+    journal, are checked against a generation that is bumped after every
+    save.
+    """
+
+    def __init__(self, path=SQLITE_FILE, max_entries=DAILY_CACHE_SIZE):
+        if _debug: DailyCache._debug("__init__ %r %r", path, max_entries)
+
+        self.path = path
+        self.max_entries = max_entries
+
+        # (meter id, day) -> (row, generation), generation is None when the
+        # day was over when the row was read
+        self.entries = OrderedDict()
+        self.generation = 0
+
+        # web threads share this
+        self.lock = threading.Lock()
+
+        # counters
+        self.hits = self.misses = 0
+
+    def invalidate(self):
+        """New rows have been saved, forget what is known about today."""
+        if _debug: DailyCache._debug("invalidate")
+
+        with self.lock:
+            self.generation += 1
+
+    def daily_reading(self, meter_id, date_str):
+        """Return the first, last and largest good readings of a meter on a
+        day, None if there are none."""
+        key = (meter_id, date_str)
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and ((entry[1] is None) or (entry[1] == self.generation)):
+                # most recently used goes to the end
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            generation = self.generation
+
+        # read it outside the lock, a day is only over when a later one has
+        # been saved, not by the clock
+        conn = connect(self.path)
+        try:
+            row = daily_reading(conn, meter_id, date_str)
+            saved_time = checkpoint(conn, 'saved_time')
+        finally:
+            conn.close()
+        day_over = bool(saved_time) and (date_str < time.strftime('%Y-%m-%d', time.localtime(saved_time)))
+
+        with self.lock:
+            self.entries[key] = (row, None if day_over else generation)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return row
+
+    def max_reading(self, meter_id, date_str):
+        """Return the largest good reading of a meter on a day, None if there
+        are none."""
+        row = self.daily_reading(meter_id, date_str)
+        if row is None:
+            return None
+        return row[2]
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+"""
+Meter Definitions
+
+Build the point list and the grs/busbar groups for the web page from
+MeterDefinitions.xls.  The result is compiled into a cache file keyed by the
+modification time and hash of the spreadsheet, so xlrd only has to parse it
+when it has actually changed.
+"""
+
+import os
+import marshal
+import hashlib
+
+from bacpypes.debugging import ModuleLogger, function_debugging
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# bump this when the layout of the cache changes
+CACHE_VERSION = 1
+
+# default location of the compiled definitions
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meterdefs.cache')
+
+#
+#   file_stat
+#
+
+def file_stat(path):
+    """Return the modification time and size of a file, None if it is missing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+#
+#   file_hash
+#
+
+def file_hash(path):
+    """Return the SHA-1 of the contents of a file."""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+#
+#   read_definitions
+#
+
+@function_debugging
+def read_definitions(path):
+    """Parse the spreadsheet, return the point list and the dict of dict of
+    lists of program ids by grs and busbar."""
+    if _debug: read_definitions._debug("read_definitions %r", path)
+    from xlrd import open_workbook
+
+    book = open_workbook(path)
+    sheet = book.sheet_by_index(0)
+
+    number_of_rows = sheet.nrows
+
+    point_list = []
+    dict_mako = {}
+    for row_index in xrange(1, number_of_rows):
+        address=str(sheet.cell(row_index, 6).value)
+        programid=str(int(sheet.cell(row_index, 0).value))
+        object_instance = int(sheet.cell(row_index, 3).value)
+        point_list.append([address, 'analogInput', object_instance, "presentValue", programid])
+
+        #create dict of dict of list to send to mako
+        grs_key=sheet.cell(row_index, 5).value
+        busbar_key=sheet.cell(row_index, 4).value
+
+        if not grs_key in dict_mako:
+            dict_mako[grs_key] = {}
+        if not busbar_key in dict_mako[grs_key]:
+            dict_mako[grs_key][busbar_key] = []
+        dict_mako[grs_key][busbar_key].append(programid)
+
+    return point_list, dict_mako
+
+#
+#   load_definitions
+#
+
+@function_debugging
+def load_definitions(path, cache_path=CACHE_FILE):
+    """Return the point list and groups, from the cache if the spreadsheet
+    has not changed."""
+    if _debug: load_definitions._debug("load_definitions %r %r", path, cache_path)
+
+    stat = file_stat(path)
+    if stat is None:
+        raise IOError, "%s not found" % (path,)
+
+    # try the cache
+    cache = None
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = marshal.load(f)
+        if cache.get('version') != CACHE_VERSION:
+            cache = None
+    except (IOError, EOFError, ValueError, TypeError):
+        cache = None
+
+    # same file, nothing to check
+    if cache and (cache['path'] == path) and (cache['stat'] == stat):
+        if _debug: load_definitions._debug("    - cache hit")
+        return cache['point_list'], cache['dict_mako']
+
+    # touched but the same contents, just update the key
+    digest = file_hash(path)
+    if cache and (cache['path'] == path) and (cache['hash'] == digest):
+        if _debug: load_definitions._debug("    - same contents")
+        cache['stat'] = stat
+    else:
+        if _debug: load_definitions._debug("    - compiling")
+        point_list, dict_mako = read_definitions(path)
+        cache = {'version': CACHE_VERSION, 'path': path, 'stat': stat, 'hash': digest,
+            'point_list': point_list, 'dict_mako': dict_mako,
+            }
+
+    # save it for next time, the cache is only an optimization
+    try:
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            marshal.dump(cache, f)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError), err:
+        load_definitions._warning("unable to save %s: %s", cache_path, err)
+
+    return cache['point_list'], cache['dict_mako']
+
+#
+#   diff_points
+#
+
+def diff_points(old_points, new_points):
+    """Return the points that were added and the points that were removed."""
+    old_set = set(tuple(point) for point in old_points)
+    new_set = set(tuple(point) for point in new_points)
+
+    added = [point for point in new_points if tuple(point) not in old_set]
+    removed = [point for point in old_points if tuple(point) not in new_set]
+
+    return added, removed
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+"""
+Meter Journal
+
+Each save of the readings is appended to a local journal file before it goes
+to the database, so a locked database or a restart does not lose it.  The
+append is a buffered write that the BACnet loop can afford, a flusher thread
+syncs the file to disk in batches, saves the records to the database in
+order and retries with a growing delay while the database is unavailable.
+When everything in the journal is saved the file is emptied.
+
+Each line is the CRC-32 of a JSON record followed by the record, a line that
+was only partly written when the process stopped fails the check and is
+ignored.  Records have a sequence number that is saved in the same
+transaction as the rows, so a record that was saved just before a restart
+is skipped when the journal is replayed.
+"""
+
+import os
+import json
+import zlib
+import threading
+
+from collections import deque
+from time import sleep as _sleep
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+
+import meterreadings
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# default file
+JOURNAL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'readings.journal')
+
+# seconds the flusher waits to collect appends into one sync
+SYNC_INTERVAL = 1.0
+
+# delay bounds while the database is unavailable, seconds
+RETRY_MIN = 1.0
+RETRY_MAX = 60.0
+
+#
+#   JournalRecord
+#
+
+class JournalRecord(object):
+
+    __slots__ = ('seq', 'save_time', 'readings')
+
+    def __init__(self, seq, save_time, readings):
+        self.seq = seq
+        self.save_time = save_time
+        self.readings = readings
+
+    def encode(self):
+        """Return the journal line."""
+        payload = json.dumps({'seq': self.seq, 'time': self.save_time,
+            'readings': [[program_id] + list(reading) for program_id, reading in self.readings.iteritems()],
+            }, separators=(',', ':'))
+        return "%08x %s\n" % (zlib.crc32(payload) & 0xffffffff, payload)
+
+    @classmethod
+    def decode(cls, line):
+        """Return the record in a journal line, None if it is damaged."""
+        try:
+            crc, payload = line.rstrip('\n').split(' ', 1)
+            if int(crc, 16) != (zlib.crc32(payload) & 0xffffffff):
+                return None
+            content = json.loads(payload)
+        except ValueError:
+            return None
+
+        readings = {}
+        for program_id, value, timestamp, quality in content['readings']:
+            readings[program_id] = meterreadings.Reading(value, timestamp, quality)
+        return cls(content['seq'], content['time'], readings)
+
+#
+#   Journal
+#
+
+@bacpypes_debugging
+class Journal(object):
+
+    def __init__(self, path=JOURNAL_FILE, last_seq=0):
+        """Open the journal, the records after last_seq that are already in
+        it are waiting to be saved."""
+        if _debug: Journal._debug("__init__ %r %r", path, last_seq)
+
+        self.path = path
+
+        # records appended and not saved yet
+        self.pending = deque()
+        self.replay(last_seq)
+
+        self.next_seq = last_seq + 1
+        if self.pending:
+            self.next_seq = max(self.next_seq, self.pending[-1].seq + 1)
+
+        self.file = open(path, 'ab')
+        self.dirty = False
+
+        # start a fresh line after one that was cut short
+        if self.file.tell() and (not self.ends_with_newline()):
+            self.file.write('\n')
+
+        # the loop thread appends, the flusher syncs and saves
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+
+    def replay(self, last_seq):
+        """Load the records from a previous run that were not saved."""
+        if not os.path.exists(self.path):
+            return
+
+        damaged = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                record = JournalRecord.decode(line)
+                if record is None:
+                    damaged += 1
+                elif record.seq > last_seq:
+                    self.pending.append(record)
+
+        if self.pending or damaged:
+            Journal._info("replaying %d records, %d damaged", len(self.pending), damaged)
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, 2)
+            return f.read(1) == '\n'
+
+    def append(self, save_time, readings):
+        """Add the readings saved at an epoch time."""
+        with self.lock:
+            record = JournalRecord(self.next_seq, save_time, readings)
+            self.next_seq += 1
+
+            self.file.write(record.encode())
+            self.dirty = True
+            self.pending.append(record)
+            self.appended.notify()
+
+        if _debug: Journal._debug("append %r", record.seq)
+
+    def sync(self):
+        """Make sure the appended records are on disk."""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.file.flush()
+            self.dirty = False
+            fileno = self.file.fileno()
+
+        # outside the lock so appends are not held up by the disk
+        os.fsync(fileno)
+
+    def next_record(self, timeout):
+        """Return the oldest record that is not saved, waiting for one up to
+        timeout seconds, None if there is not one."""
+        with self.lock:
+            if not self.pending:
+                self.appended.wait(timeout)
+            if self.pending:
+                return self.pending[0]
+            return None
+
+    def saved(self, record):
+        """The record is in the database, empty the file when nothing is
+        left to save."""
+        with self.lock:
+            if self.pending and (self.pending[0] is record):
+                self.pending.popleft()
+            if not self.pending:
+                self.file.close()
+                self.file = open(self.path, 'wb')
+                self.dirty = False
+
+#
+#   JournalFlusher
+#
+
+@bacpypes_debugging
+class JournalFlusher(threading.Thread):
+
+    def __init__(self, journal, save):
+        """Save each record of the journal in order with save(record)."""
+        if _debug: JournalFlusher._debug("__init__ %r %r", journal, save)
+        threading.Thread.__init__(self, name="JournalFlusher")
+        self.daemon = True
+
+        self.journal = journal
+        self.save = save
+        self.delay = RETRY_MIN
+
+    def run(self):
+        while True:
+            record = self.journal.next_record(SYNC_INTERVAL)
+            if record is None:
+                continue
+
+            # let more appends land, then sync them together
+            if self.journal.dirty:
+                _sleep(SYNC_INTERVAL)
+                self.journal.sync()
+
+            try:
+                self.save(record)
+            except Exception, err:
+                JournalFlusher._warning("save %d failed, retry in %gs: %s", record.seq, self.delay, err)
+                _sleep(self.delay)
+                self.delay = min(self.delay * 2, RETRY_MAX)
+                continue
+
+            self.delay = RETRY_MIN
+            self.journal.saved(record)
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+
+"""
+Meter Readings
+
+The poller publishes each reading as soon as it arrives, the web application
+and the recorder take a snapshot of all of the readings when they need them
+without locking.  The store also keeps a short log of which points changed
+in each version so a push channel can send just the changes, and pick up
+where a client left off when it reconnects.
+"""
+
+import threading
+
+from array import array
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from time import time as _time, sleep as _sleep
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# reading quality
+GOOD = 0            # value read from the device
+ERROR = 1           # the device returned an error, reject or abort
+TIMEOUT = 2         # the device did not respond
+OFFLINE = 3         # not read, the device is being skipped
+
+# the value of a reading that is not good
+NAN = float('nan')
+
+# number of changes kept for clients catching up
+CHANGE_LOG_SIZE = 10000
+
+#
+#   Reading
+#
+
+Reading = namedtuple('Reading', ('value', 'timestamp', 'quality'))
+
+#
+#   Snapshot
+#
+
+# the readings dict of a snapshot is never changed once it is made
+Snapshot = namedtuple('Snapshot', ('version', 'readings'))
+
+#
+#   ReadingStore
+#
+
+@bacpypes_debugging
+class ReadingStore(object):
+
+    """
+    The readings are kept in parallel typed arrays of value, timestamp and
+    quality with a slot for each point, so a sweep writes over the same
+    memory rather than making new objects, and the store stays small with
+    tens of thousands of meters.  Writers change the slots in place with a
+    sequence number that is odd while they are writing.
+
+    Readers take a Snapshot without a lock by copying the arrays, which is
+    one C level copy each, and trying again if the sequence number changed
+    while they did.  The snapshot of a version is made once and shared.  A
+    batch of changes, like all of the results of a ReadPropertyMultiple,
+    is seen by readers all at once.
+    """
+
+    def __init__(self, change_log_size=CHANGE_LOG_SIZE):
+        if _debug: ReadingStore._debug("__init__")
+
+        # program id of each slot, None when the slot is free
+        self.ids = []
+        self.index = {}
+        self.free = []
+
+        # the readings
+        self.values = array('d')
+        self.timestamps = array('d')
+        self.qualities = array('b')
+
+        # bumped for every change
+        self.version = 0
+
+        # odd while a writer is changing the slots
+        self.sequence = 0
+
+        # the snapshot of the latest version a reader asked for
+        self.current = Snapshot(0, {})
+
+        # different every time the application starts so versions from
+        # before a restart are not mistaken for current ones
+        self.token = "%x" % (int(_time() * 1000),)
+
+        # (version, program id) of the recent changes
+        self.changes = deque(maxlen=change_log_size)
+
+        # writers take turns, the push channel waits for a change
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+
+        # program ids changed in the batch that is being written
+        self.pending = None
+
+        # functions called with the changed readings, None for the ones
+        # removed, after each change or batch
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def readings(self):
+        return self.snapshot().readings
+
+    @contextmanager
+    def batch(self):
+        """Make the changes in the block visible to readers together."""
+        with self.lock:
+            if self.pending is not None:
+                # already in a batch
+                yield
+                return
+
+            self.pending = []
+            self.sequence += 1
+            try:
+                yield
+            finally:
+                self.sequence += 1
+                pending, self.pending = self.pending, None
+                self._changed(pending)
+
+    def _changed(self, program_ids):
+        """Wake the waiters and tell the listeners, with the lock held."""
+        if not program_ids:
+            return
+
+        self.changed.notify_all()
+        if self.listeners:
+            changed = dict((program_id, self.get(program_id)) for program_id in program_ids)
+            for listener in self.listeners:
+                listener(changed)
+
+    def get(self, program_id):
+        """Return the reading of a point, None if there is not one."""
+        slot = self.index.get(program_id)
+        if slot is None:
+            return None
+
+        quality = self.qualities[slot]
+        value = self.values[slot] if quality == GOOD else None
+        return Reading(value, self.timestamps[slot], quality)
+
+    def publish(self, program_id, value, quality=GOOD, timestamp=None):
+        """Save a new reading for a point."""
+        if _debug: ReadingStore._debug("publish %r %r %r %r", program_id, value, quality, timestamp)
+
+        if timestamp is None:
+            timestamp = _time()
+        if quality != GOOD:
+            value = NAN
+
+        with self.lock:
+            # odd before a slot is handed out or the arrays grow, a reader
+            # must not copy a slot that is half set up
+            if self.pending is None:
+                self.sequence += 1
+
+            slot = self.index.get(program_id)
+            if slot is None:
+                if self.free:
+                    slot = self.free.pop()
+                    self.ids[slot] = program_id
+                else:
+                    # the only time the arrays grow
+                    slot = len(self.ids)
+                    self.ids.append(program_id)
+                    self.values.append(NAN)
+                    self.timestamps.append(0.0)
+                    self.qualities.append(OFFLINE)
+                self.index[program_id] = slot
+
+            self.values[slot] = value
+            self.timestamps[slot] = timestamp
+            self.qualities[slot] = quality
+            self.version += 1
+            self.changes.append((self.version, program_id))
+
+            if self.pending is None:
+                self.sequence += 1
+                self._changed((program_id,))
+            else:
+                self.pending.append(program_id)
+
+    def remove(self, program_id):
+        """Forget a point that is no longer in the point list."""
+        if _debug: ReadingStore._debug("remove %r", program_id)
+
+        with self.lock:
+            if program_id not in self.index:
+                return
+
+            if self.pending is None:
+                self.sequence += 1
+            slot = self.index.pop(program_id)
+            self.ids[slot] = None
+            self.free.append(slot)
+            self.version += 1
+            self.changes.append((self.version, program_id))
+
+            if self.pending is None:
+                self.sequence += 1
+                self._changed((program_id,))
+            else:
+                self.pending.append(program_id)
+
+    def snapshot(self):
+        """Return the version and the readings, which must not be changed."""
+        current = self.current
+        if current.version == self.version:
+            return current
+
+        while True:
+            sequence = self.sequence
+            if sequence & 1:
+                # a writer is in the middle of a batch
+                _sleep(0)
+                continue
+
+            version = self.version
+            ids = self.ids[:]
+            values = self.values[:]
+            timestamps = self.timestamps[:]
+            qualities = self.qualities[:]
+            if self.sequence == sequence:
+                break
+
+        readings = {}
+        for slot, program_id in enumerate(ids):
+            if program_id is not None:
+                quality = qualities[slot]
+                value = values[slot] if quality == GOOD else None
+                readings[program_id] = Reading(value, timestamps[slot], quality)
+
+        current = self.current = Snapshot(version, readings)
+        return current
+
+    def changes_since(self, version):
+        """Return the current version and the readings of the points that
+        changed after a version, None for the points that were removed.  If
+        the version is too old for the change log, the readings are None and
+        the caller needs a snapshot."""
+        with self.lock:
+            if version == self.version:
+                return self.version, {}
+
+            # not from this run or fallen off the end of the log
+            if (version > self.version) or (not self.changes) or (version < self.changes[0][0] - 1):
+                return self.version, None
+
+            changed = {}
+            for change_version, program_id in reversed(self.changes):
+                if change_version <= version:
+                    break
+                if program_id not in changed:
+                    changed[program_id] = self.get(program_id)
+
+            return self.version, changed
+
+    def wait(self, version, timeout):
+        """Wait up to timeout seconds for the store to move on from a
+        version."""
+        with self.lock:
+            if self.version == version:
+                self.changed.wait(timeout)
+
+#
+#   EncodedSnapshot
+#
+
+@bacpypes_debugging
+class EncodedSnapshot(object):
+
+    """
+    Keep the readings encoded by a function, like the JSON for the web page,
+    and only encode them again when the store has changed.  The version is
+    turned into an ETag that is unique across restarts.
+    """
+
+    def __init__(self, store, encode):
+        if _debug: EncodedSnapshot._debug("__init__ %r %r", store, encode)
+
+        self.store = store
+        self.encode = encode
+
+        # (version, etag, body) replaced as a whole
+        self.cached = (None, None, None)
+
+        # only one thread does the encoding
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return the version, ETag and encoded body of the latest readings."""
+        cached = self.cached
+        if cached[0] == self.store.version:
+            return cached
+
+        with self.lock:
+            version, readings = self.store.snapshot()
+            cached = self.cached
+            if cached[0] != version:
+                if _debug: EncodedSnapshot._debug("get encoding %r", version)
+
+                etag = '"%s-%d"' % (self.store.token, version)
+                cached = self.cached = (version, etag, self.encode(readings))
+
+        return cached
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+"""
+Meter Series
+
+Read the saved readings of a meter, or the total of a group of meters, over
+a time range and reduce them to about as many points as a chart can show.
+
+The 'minmax' method splits the range into equal time buckets and gives the
+minimum, maximum and last reading of each, which keeps the spikes.  The
+'lttb' method picks actual readings with Largest-Triangle-Three-Buckets,
+which keeps the shape of the line.
+"""
+
+from itertools import groupby
+from operator import itemgetter
+
+from bacpypes.debugging import ModuleLogger, function_debugging
+
+import meterdb
+import meterreadings
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# downsampling methods
+METHODS = ('minmax', 'lttb')
+
+# how far back to look for the reading a meter of a group had at the start
+SEED_WINDOW = 31 * 86400
+
+#
+#   read_series
+#
+
+@function_debugging
+def read_series(conn, meter_ids, start, end):
+    """Generate the (date_time, value) good readings from start up to but
+    not including end, epoch seconds.  For more than one meter the values
+    saved at the same time are added together, a meter without a good
+    reading at that time counts with its last good one, and a meter that
+    has not had a good reading yet is left out of the total."""
+    if _debug: read_series._debug("read_series %r %r %r", meter_ids, start, end)
+
+    if len(meter_ids) == 1:
+        # only the months in the range, in order
+        for table in meterdb.partitions_between(conn, start, end):
+            cursor = conn.execute('''SELECT date_time, value FROM %s
+                WHERE id = ? AND date_time >= ? AND date_time < ? AND quality = ?
+                ORDER BY date_time''' % (table,),
+                (meter_ids[0], start, end, meterreadings.GOOD),
+                )
+            for row in cursor:
+                yield row
+        return
+
+    # the readings each meter had going in
+    last = {}
+    for meter_id in set(meter_ids):
+        value = last_good(conn, meter_id, start)
+        if value is not None:
+            last[meter_id] = value
+
+    for table in meterdb.partitions_between(conn, start, end):
+        cursor = conn.execute('''SELECT date_time, id, value, quality FROM %s
+            WHERE id IN (%s) AND date_time >= ? AND date_time < ?
+            ORDER BY date_time''' % (table, ','.join('?' * len(meter_ids))),
+            tuple(meter_ids) + (start, end),
+            )
+
+        for date_time, rows in groupby(cursor, itemgetter(0)):
+            for date_time, meter_id, value, quality in rows:
+                if quality == meterreadings.GOOD:
+                    last[meter_id] = value
+            if last:
+                yield (date_time, sum(last.values()))
+
+#
+#   last_good
+#
+
+def last_good(conn, meter_id, before):
+    """Return the last good reading of a meter before an epoch time, looking
+    back as far as SEED_WINDOW, or None."""
+    for table in reversed(meterdb.partitions_between(conn, before - SEED_WINDOW, before)):
+        row = conn.execute('''SELECT value FROM %s
+            WHERE id = ? AND date_time < ? AND quality = ?
+            ORDER BY date_time DESC LIMIT 1''' % (table,),
+            (meter_id, before, meterreadings.GOOD),
+            ).fetchone()
+        if row:
+            return row[0]
+    return None
+
+#
+#   minmax_buckets
+#
+
+def minmax_buckets(points, start, end, count):
+    """Generate [bucket_start, min, max, last] for each of count equal time
+    buckets that has readings, as soon as the bucket is finished."""
+    width = max(1, (end - start + count - 1) // count)
+
+    bucket = None
+    for date_time, value in points:
+        index = (date_time - start) // width
+        if (bucket is None) or (index != bucket[0]):
+            if bucket is not None:
+                yield [start + bucket[0] * width, bucket[1], bucket[2], bucket[3]]
+            bucket = [index, value, value, value]
+        else:
+            if value < bucket[1]:
+                bucket[1] = value
+            if value > bucket[2]:
+                bucket[2] = value
+            bucket[3] = value
+
+    if bucket is not None:
+        yield [start + bucket[0] * width, bucket[1], bucket[2], bucket[3]]
+
+#
+#   lttb
+#
+
+def lttb(points, count):
+    """Generate count of the points picked by Largest-Triangle-Three-Buckets,
+    always including the first and last."""
+    points = list(points)
+    if (count >= len(points)) or (count < 3):
+        for point in points:
+            yield point
+        return
+
+    # the first and last points are kept, the rest are in count - 2 buckets
+    every = float(len(points) - 2) / (count - 2)
+
+    a = 0
+    yield points[0]
+    for i in xrange(count - 2):
+        # average of the next bucket
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_points = points[next_start:next_end] or points[-1:]
+        avg_x = float(sum(p[0] for p in next_points)) / len(next_points)
+        avg_y = float(sum(p[1] for p in next_points)) / len(next_points)
+
+        # the point in this bucket with the largest triangle
+        ax, ay = points[a]
+        best_area = -1.0
+        best = None
+        for j in xrange(int(i * every) + 1, int((i + 1) * every) + 1):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+
+        yield points[best]
+        a = best
+
+    yield points[-1]
+
+#
+#   downsample
+#
+
+def downsample(points, start, end, count, method='minmax'):
+    """Return a generator of the downsampled points."""
+    if method == 'minmax':
+        return minmax_buckets(points, start, end, count)
+    elif method == 'lttb':
+        return lttb(points, count)
+    else:
+        raise ValueError, "unknown method: %r" % (method,)
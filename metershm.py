@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+"""
+Meter Shared Memory
+
+When the poller, recorder and web application run as separate processes the
+current readings are passed through a memory mapped file with a fixed
+layout.  A header is followed by an array of slots, one per point, each with
+the program id, value, timestamp and quality of its latest reading.
+
+The poller is the only writer.  Each slot has a sequence number that is odd
+while the slot is being written, so a reader that sees it change, or sees it
+odd, reads the slot again.  The header has a generation number that is
+bumped after every write so readers can tell when something has changed.
+"""
+
+import os
+import mmap
+import struct
+import threading
+
+from time import sleep as _sleep
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+
+import meterreadings
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# default file
+SHARED_READINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'readings.shm')
+
+# default number of slots, fixed so the file keeps its size when the point
+# list changes between restarts
+SHARED_READINGS_SLOTS = 4096
+
+# magic, layout version, number of slots, generation
+HEADER = struct.Struct('<4sIIQ')
+HEADER_SIZE = 32
+MAGIC = 'MTRS'
+LAYOUT_VERSION = 1
+
+# sequence, program id, value, timestamp, quality
+SLOT = struct.Struct('<I16sddi')
+SLOT_SIZE = SLOT.size
+
+# quality of a slot that is not in use
+EMPTY = -1
+
+# where the generation is in the header
+GENERATION = struct.Struct('<Q')
+GENERATION_OFFSET = 12
+
+# where the count of recorder saves is in the header, the recorder writes it
+# and the web application drops what it has cached about today
+SAVED = struct.Struct('<I')
+SAVED_OFFSET = 20
+
+# where the sequence is in a slot
+SEQUENCE = struct.Struct('<I')
+
+# seconds between checks of the file by a mirror
+MIRROR_INTERVAL = 1.0
+
+# times to read a slot that is being written, the reads after the first few
+# wait a millisecond, a writer that stopped in the middle is given up on
+READ_SPINS = 10
+READ_RETRIES = 100
+
+#
+#   SharedReadings
+#
+
+@bacpypes_debugging
+class SharedReadings(object):
+
+    def __init__(self, path=SHARED_READINGS_FILE, slots=None):
+        """Map the file.  The writer gives the number of slots and the file
+        is cleared, readers map what the writer made."""
+        if _debug: SharedReadings._debug("__init__ %r %r", path, slots)
+
+        self.path = path
+        size = None if slots is None else HEADER_SIZE + slots * SLOT_SIZE
+
+        if (slots is None) or os.path.exists(path):
+            f = open(path, 'r+b')
+        else:
+            f = open(path, 'w+b')
+        try:
+            f.seek(0, 2)
+            if size is None:
+                size = f.tell()
+                if size < HEADER_SIZE:
+                    raise IOError, "%s is not ready" % (path,)
+            elif f.tell() < size:
+                # a file that is big enough is reused as it is, readers may
+                # have it mapped and it cannot be shrunk under them on Windows
+                f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE)
+        finally:
+            f.close()
+
+        if slots is None:
+            magic, layout, self.slots, generation = HEADER.unpack_from(self.map, 0)
+            if (magic != MAGIC) or (layout != LAYOUT_VERSION) or (size < HEADER_SIZE + self.slots * SLOT_SIZE):
+                self.map.close()
+                raise IOError, "%s is not ready" % (path,)
+        else:
+            self.slots = slots
+
+            # start empty, keep counting the generation so readers notice
+            generation = 0
+            if self.map[:4] == MAGIC:
+                generation = GENERATION.unpack_from(self.map, GENERATION_OFFSET)[0] + 1
+            for index in xrange(slots):
+                SLOT.pack_into(self.map, HEADER_SIZE + index * SLOT_SIZE, 0, '', 0.0, 0.0, EMPTY)
+            HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, slots, generation)
+
+        # writer side, slot of each program id and the slots not in use
+        self.index = {}
+        self.free = range(self.slots - 1, -1, -1)
+
+    def close(self):
+        self.map.close()
+
+    def generation(self):
+        return GENERATION.unpack_from(self.map, GENERATION_OFFSET)[0]
+
+    def saved(self):
+        return SAVED.unpack_from(self.map, SAVED_OFFSET)[0]
+
+    def mark_saved(self):
+        SAVED.pack_into(self.map, SAVED_OFFSET, (self.saved() + 1) & 0xFFFFFFFF)
+
+    def layout(self):
+        """Return the magic and number of slots, they change when the writer
+        starts over with a different size."""
+        magic, layout, slots, generation = HEADER.unpack_from(self.map, 0)
+        return magic, slots
+
+    def write(self, index, program_id, reading):
+        """Write a slot, None to clear it."""
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        sequence = SEQUENCE.unpack_from(self.map, offset)[0]
+
+        # odd while it is being written
+        SEQUENCE.pack_into(self.map, offset, (sequence + 1) & 0xFFFFFFFF)
+        if reading is None:
+            SLOT.pack_into(self.map, offset, (sequence + 1) & 0xFFFFFFFF, '', 0.0, 0.0, EMPTY)
+        else:
+            value = reading.value
+            if value is None:
+                value = float('nan')
+            SLOT.pack_into(self.map, offset, (sequence + 1) & 0xFFFFFFFF,
+                program_id.encode('utf-8'), value, reading.timestamp, reading.quality)
+        SEQUENCE.pack_into(self.map, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    def read(self, index):
+        """Return the program id and reading in a slot, None if it is empty
+        or it stays in the middle of being written."""
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        for attempt in xrange(READ_RETRIES):
+            sequence, program_id, value, timestamp, quality = SLOT.unpack_from(self.map, offset)
+            if (sequence & 1) or (SEQUENCE.unpack_from(self.map, offset)[0] != sequence):
+                if attempt >= READ_SPINS:
+                    _sleep(0.001)
+                continue
+            if quality == EMPTY:
+                return None
+            if quality != meterreadings.GOOD:
+                value = None
+            return program_id.rstrip('\0'), meterreadings.Reading(value, timestamp, quality)
+
+        SharedReadings._warning("slot %d is still being written", index)
+        return None
+
+    def snapshot(self):
+        """Return the generation and a dict of readings by program id."""
+        generation = self.generation()
+
+        readings = {}
+        for index in xrange(self.slots):
+            slot = self.read(index)
+            if slot:
+                readings[slot[0]] = slot[1]
+
+        return generation, readings
+
+    def publish_changes(self, changed):
+        """Write the changed readings of a ReadingStore, None for the ones
+        removed, and bump the generation."""
+        for program_id, reading in changed.iteritems():
+            index = self.index.get(program_id)
+            if reading is None:
+                if index is not None:
+                    self.write(index, program_id, None)
+                    del self.index[program_id]
+                    self.free.append(index)
+                continue
+
+            if index is None:
+                if not self.free:
+                    SharedReadings._warning("no slot for %s", program_id)
+                    continue
+                index = self.index[program_id] = self.free.pop()
+            self.write(index, program_id, reading)
+
+        GENERATION.pack_into(self.map, GENERATION_OFFSET, self.generation() + 1)
+
+#
+#   SharedReadingsMirror
+#
+
+@bacpypes_debugging
+class SharedReadingsMirror(threading.Thread):
+
+    """
+    Keep a ReadingStore in a process that does not poll up to date with the
+    shared readings, so the web application keeps its snapshots, ETags and
+    event streams.
+    """
+
+    def __init__(self, path, store, interval=MIRROR_INTERVAL, on_saved=None):
+        if _debug: SharedReadingsMirror._debug("__init__ %r %r %r %r", path, store, interval, on_saved)
+        threading.Thread.__init__(self, name="SharedReadingsMirror")
+        self.daemon = True
+
+        self.path = path
+        self.store = store
+        self.interval = interval
+
+        # called when the recorder has saved
+        self.on_saved = on_saved
+
+        self.shared = None
+        self.layout = None
+        self.generation = None
+        self.saved = None
+
+    def mark_saved(self):
+        """Tell the other processes the recorder has saved."""
+        if self.shared:
+            self.shared.mark_saved()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception, err:
+                SharedReadingsMirror._exception("refresh failed: %s", err)
+            _sleep(self.interval)
+
+    def refresh(self):
+        # wait for the poller to make the file
+        if not self.shared:
+            try:
+                self.shared = SharedReadings(self.path)
+            except (IOError, OSError, ValueError, struct.error):
+                return
+            self.layout = self.shared.layout()
+            self.generation = None
+
+        # the poller started over with a different size
+        if self.shared.layout() != self.layout:
+            if _debug: SharedReadingsMirror._debug("refresh new layout")
+            self.shared.close()
+            self.shared = None
+            return
+
+        saved = self.shared.saved()
+        if saved != self.saved:
+            if (self.saved is not None) and self.on_saved:
+                self.on_saved()
+            self.saved = saved
+
+        generation = self.shared.generation()
+        if generation == self.generation:
+            return
+        if _debug: SharedReadingsMirror._debug("refresh %r", generation)
+
+        self.generation, readings = self.shared.snapshot()
+        version, current = self.store.snapshot()
+
+        with self.store.batch():
+            for program_id, reading in readings.iteritems():
+                if current.get(program_id) != reading:
+                    self.store.publish(program_id, reading.value, reading.quality, reading.timestamp)
+            for program_id in current:
+                if program_id not in readings:
+                    self.store.remove(program_id)
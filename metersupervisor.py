@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+"""
+Meter Supervisor
+
+Run each part of the application as its own process and start it again if
+it stops, waiting a little longer each time it stops soon after starting.
+"""
+
+import sys
+import subprocess
+
+from time import time as _time, sleep as _sleep
+
+from bacpypes.debugging import bacpypes_debugging, ModuleLogger
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+# seconds between checks of the children
+CHECK_INTERVAL = 2.0
+
+# restart delay bounds, seconds
+RESTART_MIN = 1.0
+RESTART_MAX = 60.0
+
+# a child that ran this long is healthy and the delay starts over
+HEALTHY_RUN = 60.0
+
+#
+#   Child
+#
+
+class Child(object):
+
+    def __init__(self, role, args):
+        self.role = role
+        self.args = args
+        self.process = None
+        self.started = None
+        self.delay = RESTART_MIN
+        self.restart_at = 0.0
+
+#
+#   Supervisor
+#
+
+@bacpypes_debugging
+class Supervisor(object):
+
+    def __init__(self, script, roles, args):
+        """Run script with args and --role for each of the roles."""
+        if _debug: Supervisor._debug("__init__ %r %r %r", script, roles, args)
+
+        self.children = [Child(role, [sys.executable, script] + list(args) + ['--role', role])
+            for role in roles]
+
+    def start(self, child):
+        Supervisor._info("starting %s", child.role)
+        child.process = subprocess.Popen(child.args)
+        child.started = _time()
+
+    def check(self):
+        """Start the children that are not running."""
+        now = _time()
+        for child in self.children:
+            if child.process is not None:
+                status = child.process.poll()
+                if status is None:
+                    continue
+
+                Supervisor._warning("%s stopped with %r", child.role, status)
+                child.process = None
+
+                # back off when it keeps stopping
+                if now - child.started >= HEALTHY_RUN:
+                    child.delay = RESTART_MIN
+                else:
+                    child.delay = min(child.delay * 2, RESTART_MAX)
+                child.restart_at = now + child.delay
+
+            if now >= child.restart_at:
+                self.start(child)
+
+    def stop(self):
+        for child in self.children:
+            if child.process and (child.process.poll() is None):
+                Supervisor._info("stopping %s", child.role)
+                child.process.terminate()
+        for child in self.children:
+            if child.process:
+                child.process.wait()
+
+    def run(self):
+        try:
+            while True:
+                self.check()
+                _sleep(CHECK_INTERVAL)
+        finally:
+            self.stop()
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+"""
+Migrate Tenant Data
+
+Convert tenantdata.sqlite from the original text schema to the indexed one
+with epoch timestamps, numeric values and a quality column.  The conversion
+is done in place in chunks and can be stopped and started again.
+"""
+
+import sys
+
+from bacpypes.debugging import ModuleLogger
+from bacpypes.consolelogging import ArgumentParser
+
+import meterdb
+
+# some debugging
+_debug = 0
+_log = ModuleLogger(globals())
+
+#
+#   show_progress
+#
+
+def show_progress(done, total):
+    sys.stdout.write("\r%d of %d rows" % (done, total))
+    sys.stdout.flush()
+
+#
+#   __main__
+#
+
+try:
+    # parse the command line arguments
+    parser = ArgumentParser(description=__doc__)
+
+    parser.add_argument('--db',
+        help="database file",
+        default=meterdb.SQLITE_FILE,
+        )
+    parser.add_argument('--chunk-size', type=int,
+        help="rows copied in each transaction",
+        default=50000,
+        )
+
+    # now parse the arguments
+    args = parser.parse_args()
+
+    if _debug: _log.debug("initialization")
+    if _debug: _log.debug("    - args: %r", args)
+
+    conn = meterdb.connect(args.db)
+    try:
+        copied, skipped = meterdb.migrate(conn, args.chunk_size, show_progress)
+    finally:
+        conn.close()
+
+    print
+    print "%d rows copied, %d skipped" % (copied, skipped)
+
+except Exception, e:
+    _log.exception("an error has occurred: %s", e)
+finally:
+    _log.debug("finally")